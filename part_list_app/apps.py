@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class PartListAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'part_list_app'
+
+    def ready(self):
+        # 部品の登録、変更、削除時に部品コードと構成ツリーのキャッシュを無効にし、検索用の n-gram を作り直す。
+        from django.db.models.signals import post_save, post_delete
+        from part_list_app.models import Part
+        from part_list_app.views import invalidate_part_cache, update_part_ngrams
+        post_save.connect(invalidate_part_cache, sender=Part)
+        post_delete.connect(invalidate_part_cache, sender=Part)
+        post_save.connect(update_part_ngrams, sender=Part)
@@ -0,0 +1,23 @@
+# build_composition_paths.py
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+from part_list_app.views import rebuild_composition_paths
+
+
+class Command(BaseCommand):
+    """
+    Compositionの経路(path)を、製品から階層毎に作り直します。
+    経路の無い既存のデータや、経路を通さずにCompositionを変更した場合に実行して下さい。
+    使い方: python manage.py build_composition_paths [--product 1 ...]
+    """
+    help = 'Compositionの経路を製品から作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, nargs='*', dest='product_ids',
+                            help='対象の製品のid(省略時は全ての製品)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_composition_paths(options['product_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'rebuilt {count} composition paths'))
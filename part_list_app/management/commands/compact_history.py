@@ -0,0 +1,37 @@
+# compact_history.py
+
+from django.core.management.base import BaseCommand
+from part_list_app.models import UndoRedoPointer
+from part_list_app.views import compact_history
+
+
+class Command(BaseCommand):
+    """
+    製品毎の構成履歴(CompositionChangeSet、CompositionHistory)を圧縮します。
+    「元に戻す」が出来る件数(--retention、省略時は設定の PART_LIST_HISTORY_RETENTION)より古い
+    構成変更セットと、更新前後で値の変わらない履歴を削除します。
+    使い方: python manage.py compact_history [--retention 100] [--product 1 ...]
+    """
+    help = '製品毎の構成履歴を、元に戻せる件数まで圧縮します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=int, default=None,
+                            help='製品毎に元に戻せる構成変更セットの件数')
+        parser.add_argument('--product', type=int, nargs='*', dest='product_ids',
+                            help='対象の製品のid(省略時は全ての製品)')
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids']
+        if not product_ids:
+            product_ids = UndoRedoPointer.objects.order_by('product_id').values_list('product_id', flat=True)
+        total_change_sets = total_histories = 0
+        for product_id in product_ids:
+            change_set_count, history_count = compact_history(product_id, options['retention'])
+            if change_set_count or history_count:
+                self.stdout.write(f'product {product_id}: removed {change_set_count} change sets, '
+                                  f'{history_count} histories')
+            total_change_sets += change_set_count
+            total_histories += history_count
+        self.stdout.write(self.style.SUCCESS(
+            f'removed {total_change_sets} change sets, {total_histories} histories'
+        ))
@@ -0,0 +1,36 @@
+# export_bom.py
+
+from django.core.management.base import BaseCommand
+from part_list_app.models import Composition
+from part_list_app.views import iter_bom_export_lines
+
+
+class Command(BaseCommand):
+    """
+    製品の構成表(階層、部品コード、部品名、数、所要量)を、変更画面と同じ順に出力します。
+    構成は1行ずつ読み込んで書き出すので、製品の大きさに関わらずメモリはほぼ一定です。
+    出力した構成表(csv、jsonl)は import_bom の indented の形式で読み込めます。
+    使い方: python manage.py export_bom [--product 1 ...] [--format csv|excel|jsonl] [--output bom.csv]
+    """
+    help = '製品の構成表を出力します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, nargs='*', dest='product_ids',
+                            help='対象の製品のid(省略時は全ての製品)')
+        parser.add_argument('--format', choices=['csv', 'excel', 'jsonl'], default='csv',
+                            help='出力形式(excel: Excel用にBOM付きのCSV)')
+        parser.add_argument('--output', help='出力先のファイル(省略時は標準出力)')
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids']
+        if not product_ids:
+            product_ids = list(Composition.objects.filter(parent_id__isnull=True).order_by('id').values_list(
+                'id', flat=True
+            ))
+        lines = iter_bom_export_lines(product_ids, options['format'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
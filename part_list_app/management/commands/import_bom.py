@@ -0,0 +1,197 @@
+# import_bom.py
+
+import csv
+import json
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from part_list_app.models import Composition, Part
+from part_list_app.views import QUERY_CHUNK_SIZE, apply_part_adjacency_deltas, check_for_cyclic_parts, \
+    invalidate_tree_cache, get_next_composition_id, reset_composition_sequence
+
+# bulk_create でまとめて書き込むCompositionの件数
+IMPORT_CHUNK_SIZE = 5000
+
+
+class Command(BaseCommand):
+    """
+    部品表(BOM)のファイルを読み込み、製品の構成(Composition)を登録します。
+    ファイルは1行ずつ読み込み、部品コードはメモリ上の部品の対応表で引き、
+    Compositionは IMPORT_CHUNK_SIZE 件毎に bulk_create で書き込みます。
+    部品の循環参照のチェックは、全ての行を書き込んだ後に製品毎に1回行います。
+
+    ファイルの形式(拡張子が .json、.jsonl の場合は1行1オブジェクトのJSON、それ以外はヘッダ付きのCSV):
+    - indented: level, code, quantity の列。level 0 の行が製品で、以降の行は1つ浅い level の直前の行の子です。
+    - parent: parent_code, code, quantity の列。部品毎の子の一覧(1階層の部品表)で、
+        他の部品の子にならない部品(または --product で指定した部品)を製品として全階層を展開します。
+    使い方: python manage.py import_bom bom.csv [--layout indented|parent] [--product pra ...] [--create-parts]
+    """
+    help = '部品表のファイルより製品の構成を登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='部品表のファイル(CSV、またはJSON Lines)')
+        parser.add_argument('--layout', choices=['indented', 'parent'], default='indented',
+                            help='階層の表し方(indented: level列、parent: 親の部品コード列)')
+        parser.add_argument('--product', nargs='*', dest='product_codes',
+                            help='parent の場合に製品とする部品コード(省略時は他の部品の子にならない部品)')
+        parser.add_argument('--create-parts', action='store_true',
+                            help='存在しない部品コードの部品を作成する(部品名は name 列、無ければ部品コード)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            writer = BomWriter(options['create_parts'])
+            rows = read_rows(options['file'])
+            if options['layout'] == 'indented':
+                import_indented(writer, rows)
+            else:
+                import_parent(writer, rows, options['product_codes'])
+            writer.finish()
+        self.stdout.write(self.style.SUCCESS(
+            f'imported {len(writer.product_ids)} products, {writer.count} compositions'
+        ))
+
+
+# ファイルを1行ずつ読み込み、(行番号, 列名→値の辞書)を返す。
+def read_rows(file_name):
+    with open(file_name, newline='', encoding='utf-8-sig') as file:
+        if file_name.endswith(('.json', '.jsonl')):
+            for line_number, line in enumerate(file, 1):
+                if line.strip():
+                    yield line_number, json.loads(line)
+        else:
+            # 1行目はヘッダなので、データは2行目からです。
+            for line_number, row in enumerate(csv.DictReader(file), 2):
+                yield line_number, row
+
+
+def get_int(line_number, row, key):
+    try:
+        return int(row[key])
+    except (KeyError, TypeError, ValueError):
+        raise CommandError(f'{line_number}行目: {key} が不正です。')
+
+
+def import_indented(writer, rows):
+    """
+    level列で階層を表した部品表を登録する
+    直前の行から製品までの経路(スタック)だけを保持するので、ファイルの大きさに関わらずメモリは一定です。
+    :param writer: BomWriter
+    :param rows: read_rows で読み込んだ行
+    """
+    stack = []  # [[add の戻り値, 子の件数]] 製品から直前の行まで
+    for line_number, row in rows:
+        level = get_int(line_number, row, 'level')
+        part_id = writer.get_part_id(line_number, row)
+        if level == 0:
+            stack = [[writer.add(None, part_id, None, 1), 0]]
+            continue
+        if not 0 < level <= len(stack):
+            raise CommandError(f'{line_number}行目: level {level} の親がありません。')
+        del stack[level:]
+        parent = stack[-1]
+        parent[1] += 1
+        stack.append([writer.add(parent[0], part_id, get_int(line_number, row, 'quantity'), parent[1]), 0])
+
+
+def import_parent(writer, rows, product_codes=None):
+    """
+    親の部品コード列で表した1階層の部品表を、製品毎に全階層へ展開して登録する
+    部品毎の子の一覧(ファイルの行数分)を保持し、展開した構成は保持せずに書き込みます。
+    展開中に経路上の部品が子に現れた場合は、部品が循環しているので中止します。
+    :param writer: BomWriter
+    :param rows: read_rows で読み込んだ行
+    :param product_codes: 製品とする部品コードのリスト(None の場合は他の部品の子にならない部品)
+    """
+    children_map = {}   # 親の部品ID→[(子の部品ID, 数)]
+    child_part_ids = set()
+    for line_number, row in rows:
+        parent_part_id = writer.get_part_id(line_number, row, 'parent_code')
+        part_id = writer.get_part_id(line_number, row)
+        children_map.setdefault(parent_part_id, []).append((part_id, get_int(line_number, row, 'quantity')))
+        child_part_ids.add(part_id)
+
+    if product_codes:
+        unknown_codes = [code for code in product_codes if code not in writer.part_ids]
+        if unknown_codes:
+            raise CommandError(f'存在しない製品の部品コード {", ".join(unknown_codes)} が指定されました。')
+        product_part_ids = [writer.part_ids[code] for code in product_codes]
+    else:
+        product_part_ids = [part_id for part_id in children_map if part_id not in child_part_ids]
+    for product_part_id in product_part_ids:
+        product = writer.add(None, product_part_id, None, 1)
+        path_part_ids = {product_part_id}   # 現在展開している経路上の部品のIDのセット
+        stack = [(product, product_part_id, enumerate(children_map.get(product_part_id, []), 1))]
+        while stack:
+            parent, parent_part_id, children = stack[-1]
+            sort, child = next(children, (None, None))
+            if child is None:
+                stack.pop()
+                path_part_ids.discard(parent_part_id)
+                continue
+            part_id, quantity = child
+            if part_id in path_part_ids:
+                raise CommandError(f'部品の循環参照が存在します。(部品id: {part_id})')
+            path_part_ids.add(part_id)
+            composition = writer.add(parent, part_id, quantity, sort)
+            stack.append((composition, part_id, enumerate(children_map.get(part_id, []), 1)))
+
+
+class BomWriter:
+    """
+    読み込んだ行のCompositionを、まとめて書き込む
+
+    - idは書き込み前に採番するので、親のidを待たずに子の parent_id と経路(path)を決められます。
+      (既存のCompositionと、構成履歴より作り直す可能性のあるidより後ろから採番し、最後にシーケンスを合わせます)
+    - 部品の隣接関係(PartAdjacency)の件数は、(親の部品ID, 子の部品ID)毎に数えて最後にまとめて反映します。
+    """
+
+    def __init__(self, create_parts=False):
+        self.create_parts = create_parts
+        self.part_ids = dict(Part.objects.values_list('code', 'id'))
+        self.next_id = get_next_composition_id()
+        self.compositions = []
+        self.adjacency_deltas = Counter()
+        self.product_ids = []
+        self.count = 0
+
+    def get_part_id(self, line_number, row, key='code'):
+        code = row.get(key)
+        part_id = self.part_ids.get(code)
+        if part_id is None:
+            if not self.create_parts or not code:
+                raise CommandError(f'{line_number}行目: 存在しない部品コード {code} が指定されました。')
+            # 部品名は code 列の部品の場合のみ name 列より取ります。
+            name = row.get('name') if key == 'code' else None
+            part_id = Part.objects.create(code=code, name=name or code).id
+            self.part_ids[code] = part_id
+        return part_id
+
+    # Compositionを追加し、子を追加する為の (id, 経路, 部品ID) を返す。(parent が None の場合は製品)
+    def add(self, parent, part_id, quantity, sort):
+        id = self.next_id
+        self.next_id += 1
+        if parent is None:
+            parent_id, path = None, f'/{id}/'
+            self.product_ids.append(id)
+        else:
+            parent_id, path = parent[0], f'{parent[1]}{id}/'
+            self.adjacency_deltas[(parent[2], part_id)] += 1
+        self.compositions.append(Composition(id=id, parent_id=parent_id, sort=sort, part_id=part_id,
+                                             quantity=quantity, path=path))
+        if len(self.compositions) >= IMPORT_CHUNK_SIZE:
+            self.flush()
+        return id, path, part_id
+
+    def flush(self):
+        Composition.objects.bulk_create(self.compositions, batch_size=QUERY_CHUNK_SIZE)
+        self.count += len(self.compositions)
+        self.compositions = []
+
+    def finish(self):
+        self.flush()
+        apply_part_adjacency_deltas(self.adjacency_deltas)
+        for product_id in self.product_ids:
+            if check_for_cyclic_parts(product_id):
+                raise CommandError(f'部品の循環参照が存在します。(製品id: {product_id})')
+            invalidate_tree_cache(product_id)
+        reset_composition_sequence()
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='compositionhistory',
+            name='action',
+            field=models.CharField(choices=[('create', '作成'), ('update', '更新'), ('delete', '削除'), ('shift', '並び順シフト')], max_length=50, verbose_name='操作'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import Counter
+
+
+def build_part_adjacency(apps, schema_editor):
+    # 既存の Composition より親部品と子部品の隣接関係を作成する。
+    Composition = apps.get_model('part_list_app', 'Composition')
+    PartAdjacency = apps.get_model('part_list_app', 'PartAdjacency')
+    part_ids = dict(Composition.objects.values_list('id', 'part_id').iterator())
+    counts = Counter(
+        (part_ids[parent_id], part_id)
+        for parent_id, part_id in Composition.objects.filter(
+            parent_id__isnull=False
+        ).values_list('parent_id', 'part_id').iterator()
+        if parent_id in part_ids
+    )
+    PartAdjacency.objects.bulk_create([
+        PartAdjacency(parent_part_id=parent_part_id, child_part_id=child_part_id, count=count)
+        for (parent_part_id, child_part_id), count in counts.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0002_alter_compositionhistory_action'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartAdjacency',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+                ('child_part', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parent_adjacencies', to='part_list_app.part', verbose_name='子部品')),
+                ('parent_part', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='child_adjacencies', to='part_list_app.part', verbose_name='親部品')),
+            ],
+            options={
+                'verbose_name': '部品隣接関係',
+                'db_table': 'part_list_app_part_adjacency',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='partadjacency',
+            constraint=models.UniqueConstraint(fields=('parent_part', 'child_part'), name='part_adjacency_unique_parent_child'),
+        ),
+        migrations.RunPython(build_part_adjacency, migrations.RunPython.noop),
+    ]
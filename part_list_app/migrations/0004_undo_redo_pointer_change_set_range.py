@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:16
+
+from django.db import migrations, models
+from django.db.models import Min, Max, F
+import django.db.models.deletion
+
+
+def fill_change_set_range(apps, schema_editor):
+    # 既存の構成変更セットより、製品毎の最初と最後の構成変更セットのidを設定する。
+    # 最初まで「元に戻す」をしてUndoRedoPointerが削除されていた製品は、pointerを null として作成する。
+    # 製品自体を作成した('create' の履歴を持つ)構成変更セットのidも設定する。
+    CompositionChangeSet = apps.get_model('part_list_app', 'CompositionChangeSet')
+    CompositionHistory = apps.get_model('part_list_app', 'CompositionHistory')
+    UndoRedoPointer = apps.get_model('part_list_app', 'UndoRedoPointer')
+    creation_change_set_ids = dict(CompositionHistory.objects.filter(
+        action='create', composition_original_id=F('composition_change_set__product_id')
+    ).values_list('composition_change_set__product_id', 'composition_change_set_id'))
+    pointers = {pointer.product_id: pointer for pointer in UndoRedoPointer.objects.all()}
+    change_set_ranges = CompositionChangeSet.objects.order_by().values('product_id').annotate(
+        first_id=Min('id'), last_id=Max('id')
+    )
+    for change_set_range in change_set_ranges:
+        pointer = pointers.get(change_set_range['product_id'])
+        if pointer is None:
+            pointer = UndoRedoPointer(product_id=change_set_range['product_id'], pointer=None)
+        pointer.first_change_set_id = change_set_range['first_id']
+        pointer.last_change_set_id = change_set_range['last_id']
+        pointer.creation_change_set_id = creation_change_set_ids.get(change_set_range['product_id'])
+        pointer.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0003_part_adjacency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='undoredopointer',
+            name='first_change_set_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='最初の構成変更セットid'),
+        ),
+        migrations.AddField(
+            model_name='undoredopointer',
+            name='last_change_set_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='最後の構成変更セットid'),
+        ),
+        migrations.AddField(
+            model_name='undoredopointer',
+            name='creation_change_set_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='製品作成の構成変更セットid'),
+        ),
+        migrations.AlterField(
+            model_name='undoredopointer',
+            name='pointer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='part_list_app.compositionchangeset'),
+        ),
+        migrations.RunPython(fill_change_set_range, migrations.RunPython.noop),
+    ]
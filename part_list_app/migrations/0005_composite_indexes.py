@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0004_undo_redo_pointer_change_set_range'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='composition',
+            index=models.Index(fields=['parent_id', 'sort'], name='composition_parent_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compositionchangeset',
+            index=models.Index(fields=['product', 'id'], name='change_set_product_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compositionhistory',
+            index=models.Index(fields=['composition_change_set', 'id'], name='history_change_set_id_idx'),
+        ),
+    ]
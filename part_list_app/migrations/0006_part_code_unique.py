@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:32
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_part_codes(apps, schema_editor):
+    # 重複した部品コードがあると一意制約を追加できない為、重複した部品コードを示して中止する。
+    # (部品はCompositionから参照されているので、自動ではまとめません)
+    Part = apps.get_model('part_list_app', 'Part')
+    duplicates = list(
+        Part.objects.values('code').annotate(count=Count('id')).filter(count__gt=1).order_by('code').values_list(
+            'code', 'count'
+        )
+    )
+    if duplicates:
+        raise ValueError(
+            '部品コードが重複している部品があります。重複を解消してから再度 migrate を実行して下さい。\n'
+            + '\n'.join(f'  {code}: {count}件' for code, count in duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_part_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='part',
+            name='code',
+            field=models.CharField(max_length=3, unique=True, verbose_name='部品コード'),
+        ),
+    ]
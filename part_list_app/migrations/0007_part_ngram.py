@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_part_ngrams(apps, schema_editor):
+    # 既存の部品より検索用の n-gram(小文字にした1文字と連続する2文字)を作成する。
+    Part = apps.get_model('part_list_app', 'Part')
+    PartNgram = apps.get_model('part_list_app', 'PartNgram')
+    part_ngrams = []
+    for part_id, code, name in Part.objects.values_list('id', 'code', 'name').iterator():
+        ngrams = set()
+        for text in (code, name):
+            text = (text or '').lower()
+            ngrams.update(text)
+            ngrams.update(text[i:i + 2] for i in range(len(text) - 1))
+        part_ngrams.extend(PartNgram(part_id=part_id, ngram=ngram) for ngram in ngrams)
+        if len(part_ngrams) >= 5000:
+            PartNgram.objects.bulk_create(part_ngrams, batch_size=500)
+            part_ngrams = []
+    PartNgram.objects.bulk_create(part_ngrams, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0006_part_code_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartNgram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ngram', models.CharField(max_length=2, verbose_name='n-gram')),
+                ('part', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ngrams', to='part_list_app.part', verbose_name='部品')),
+            ],
+            options={
+                'verbose_name': '部品n-gram',
+                'db_table': 'part_list_app_part_ngram',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='composition',
+            index=models.Index(fields=['part', 'parent_id'], name='composition_part_parent_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='partngram',
+            constraint=models.UniqueConstraint(fields=('ngram', 'part'), name='part_ngram_unique_ngram_part'),
+        ),
+        migrations.RunPython(build_part_ngrams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+def fill_composition_path(apps, schema_editor):
+    # 既存のCompositionの経路を、製品から階層毎に設定する。
+    Composition = apps.get_model('part_list_app', 'Composition')
+    paths = {id: f'/{id}/' for id in Composition.objects.filter(parent_id__isnull=True).values_list('id', flat=True)}
+    while paths:
+        Composition.objects.bulk_update(
+            [Composition(id=id, path=path) for id, path in paths.items()], ['path'], batch_size=500
+        )
+        next_paths = {}
+        parent_ids = list(paths)
+        for i in range(0, len(parent_ids), 500):
+            children = Composition.objects.filter(parent_id__in=parent_ids[i:i + 500]).values_list('id', 'parent_id')
+            for id, parent_id in children:
+                if id not in next_paths and str(id) not in paths[parent_id].split('/'):
+                    next_paths[id] = f'{paths[parent_id]}{id}/'
+        paths = next_paths
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('part_list_app', '0007_part_ngram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='composition',
+            name='path',
+            field=models.TextField(blank=True, null=True, verbose_name='経路'),
+        ),
+        migrations.AddIndex(
+            model_name='composition',
+            index=models.Index(fields=['path'], name='composition_path_idx'),
+        ),
+        migrations.RunPython(fill_composition_path, migrations.RunPython.noop),
+    ]
@@ -6,10 +6,10 @@ class Part(models.Model):
     Part モデルは、部品情報を保持します。
 
     フィールド説明:
-    - code: 部品コード。
+    - code: 部品コード。重複は出来ません。(一意のインデックスで検索します)
     - name: 部品名。
     """
-    code = models.CharField('部品コード', max_length=3)
+    code = models.CharField('部品コード', max_length=3, unique=True)
     name = models.CharField('部品名', max_length=255)
 
     def __str__(self):
@@ -28,6 +28,10 @@ class Composition(models.Model):
     - sort: 並び順。
     - part: 部品。
     - quantity: 数。
+    - path: 製品から自身までのidを'/'で区切った経路('/製品id/.../自身のid/')。
+        配下は経路の前方一致(範囲検索)、祖先は経路のidで取得します。
+        構成の追加、移動、「元に戻す」、「やり直し」の際に parent_id と合わせて更新します。
+        階層の深さに制限を設けない為、長さに制限の無い TextField にしています。
     """
     # 以下の書き方をしてしまうと、親を消した場合、子も自動的に消されてしまい
     # undo、redo処理用の子の更新履歴情報を保持出来なくなってしまいます。
@@ -42,6 +46,7 @@ class Composition(models.Model):
                              related_name="part_compositions",
                              on_delete=models.CASCADE)
     quantity = models.IntegerField('数', null=True, default=None)
+    path = models.TextField('経路', null=True, blank=True)
 
     def __str__(self):
         #    return f'Parent_id: {self.parent_id}, Part: {self.part}'
@@ -49,6 +54,13 @@ class Composition(models.Model):
 
     class Meta:
         verbose_name = '構成'
+        # 子の取得(parent_id で絞り込み sort 順に並べる)、並び順の最大値の取得に使います。
+        # 部品と親idのインデックスは、検索で絞り込んだ部品の製品(parent == null)の取得に使います。
+        indexes = [
+            models.Index(fields=['parent_id', 'sort'], name='composition_parent_sort_idx'),
+            models.Index(fields=['part', 'parent_id'], name='composition_part_parent_idx'),
+            models.Index(fields=['path'], name='composition_path_idx'),
+        ]
 
 
 class CompositionChangeSet(models.Model):
@@ -69,6 +81,10 @@ class CompositionChangeSet(models.Model):
     class Meta:
         verbose_name = '構成変更セット'
         db_table = "part_list_app_composition_change_set"
+        # 製品毎に前後の構成変更セットを取得する際に使います。
+        indexes = [
+            models.Index(fields=['product', 'id'], name='change_set_product_id_idx'),
+        ]
 
 
 class CompositionHistory(models.Model):
@@ -86,8 +102,12 @@ class CompositionHistory(models.Model):
     - sort: 更新後のCompositionのsort。ただし削除の場合、削除前のsort。
     - part: 更新後のCompositionのpart。ただし削除の場合、削除前のpart。
     - quantity: 更新後のCompositionのquantity。ただし削除の場合、削除前のquantity。
-    - action: 操作内容、'create','update','delete'のいずれかをセット。
+    - action: 操作内容、'create','update','delete','shift'のいずれかをセット。
     - timestamp: 構成履歴が作成された日時。
+
+    'shift' は、同じ親を持つ兄弟の並び順をまとめてずらした操作を1件で表します。
+    composition_original_id、parent_original_id に兄弟の親id、sort にずらし始めた並び順(ずらす前の値)、
+    quantity にずらした数をセットします。
     """
     composition_change_set = models.ForeignKey(CompositionChangeSet, on_delete=models.CASCADE, related_name='composition_histories')
     composition_original_id = models.IntegerField()
@@ -100,7 +120,8 @@ class CompositionHistory(models.Model):
     action = models.CharField('操作', max_length=50, choices=[
         ('create', '作成'),
         ('update', '更新'),
-        ('delete', '削除')
+        ('delete', '削除'),
+        ('shift', '並び順シフト')
     ])
     status = models.CharField('ステータス', max_length=6, choices=[
         ('before', '前'),
@@ -114,6 +135,10 @@ class CompositionHistory(models.Model):
     class Meta:
         verbose_name = '構成履歴'
         db_table = "part_list_app_composition_history"
+        # 構成変更セットの履歴を pk 順に取得する際に使います。
+        indexes = [
+            models.Index(fields=['composition_change_set', 'id'], name='history_change_set_id_idx'),
+        ]
 
 
 class UndoRedoPointer(models.Model):
@@ -124,11 +149,23 @@ class UndoRedoPointer(models.Model):
     フィールド説明:
     - product: Composition インスタンスの製品(parent == null)外部キー。
     - pointer_id: 「元に戻す」、「やり直し」の構成履歴の起点id。
+        最初の構成変更セットまで「元に戻す」をした場合は null になります。
+    - first_change_set_id: 製品の最初(一番古い)の構成変更セットのid。構成変更セットが無い場合は null。
+    - last_change_set_id: 製品の最後(一番新しい)の構成変更セットのid。構成変更セットが無い場合は null。
+    - creation_change_set_id: 製品自体を作成した構成変更セットのid。(整理などで無い場合は null)
+        製品の作成は元に戻さないので、ポインタがこの構成変更セットを指す場合は「元に戻す」が出来ません。
     - timestamp: UndoRedoPointerが作成された日時。
+
+    first_change_set_id、last_change_set_id、creation_change_set_id は構成変更セットの追加、削除と
+    同じトランザクション内で更新し、「元に戻す」、「やり直し」が出来るかを CompositionChangeSet を
+    読まずに判定する為に使います。
     """
     product = models.ForeignKey(Composition, on_delete=models.CASCADE, verbose_name='製品')
     # pointer_id = models.IntegerField()
-    pointer = models.ForeignKey(CompositionChangeSet, on_delete=models.CASCADE)
+    pointer = models.ForeignKey(CompositionChangeSet, on_delete=models.CASCADE, null=True, blank=True)
+    first_change_set_id = models.BigIntegerField('最初の構成変更セットid', null=True, blank=True)
+    last_change_set_id = models.BigIntegerField('最後の構成変更セットid', null=True, blank=True)
+    creation_change_set_id = models.BigIntegerField('製品作成の構成変更セットid', null=True, blank=True)
     timestamp = models.DateTimeField('変更日時', auto_now_add=True)
 
     def __str__(self):
@@ -139,3 +176,56 @@ class UndoRedoPointer(models.Model):
         db_table = "part_list_app_undo_redo_pointer"
 
 
+class PartAdjacency(models.Model):
+    """
+    PartAdjacency モデルは、全製品の構成を部品単位にまとめた、親部品と子部品の隣接関係を保持します。
+    Composition の追加、移動、削除、「元に戻す」、「やり直し」の際に、CompositionHistory の
+    書き込みと同じトランザクション内で更新されます。
+    追加、移動の際の部品の循環参照のチェックで、配下の部品に経路上の部品が現れ得るかの判定に使います。
+
+    フィールド説明:
+    - parent_part: 親部品。
+    - child_part: 子部品。
+    - count: 親部品の直下に子部品が使われている Composition の件数。0になった場合は削除します。
+    """
+    parent_part = models.ForeignKey(Part, verbose_name='親部品', related_name='child_adjacencies',
+                                    on_delete=models.CASCADE)
+    child_part = models.ForeignKey(Part, verbose_name='子部品', related_name='parent_adjacencies',
+                                   on_delete=models.CASCADE)
+    count = models.IntegerField('件数', default=0)
+
+    def __str__(self):
+        return f'{self.parent_part} -> {self.child_part} ({self.count})'
+
+    class Meta:
+        verbose_name = '部品隣接関係'
+        db_table = "part_list_app_part_adjacency"
+        constraints = [
+            models.UniqueConstraint(fields=['parent_part', 'child_part'],
+                                    name='part_adjacency_unique_parent_child'),
+        ]
+
+
+class PartNgram(models.Model):
+    """
+    PartNgram モデルは、部品の検索用に、部品コード、部品名を区切った文字列(n-gram)を保持します。
+    小文字にした1文字と連続する2文字に区切るので、日本語の部品名も単語に区切らずに検索出来ます。
+    Part の登録、変更の際に、その部品の分を作り直します。
+
+    フィールド説明:
+    - part: 部品。
+    - ngram: 部品コード、部品名の1文字、または連続する2文字。
+    """
+    part = models.ForeignKey(Part, verbose_name='部品', related_name='ngrams', on_delete=models.CASCADE)
+    ngram = models.CharField('n-gram', max_length=2)
+
+    def __str__(self):
+        return f'{self.ngram} -> {self.part}'
+
+    class Meta:
+        verbose_name = '部品n-gram'
+        db_table = "part_list_app_part_ngram"
+        # n-gramで部品を検索する際のインデックスを兼ねます。
+        constraints = [
+            models.UniqueConstraint(fields=['ngram', 'part'], name='part_ngram_unique_ngram_part'),
+        ]
@@ -1,9 +1,72 @@
 # custom_tags.py
 
 from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 
 register = template.Library()
 
-@register.inclusion_tag('part_list_app/recursive_nodes.html')
+# 子を持つ行(開閉アイコン付き)。子のリストは続けて出力し、最後に</li>で閉じる。
+PART_UP_HTML = (
+    '<li id="{id}" class="block-part-list" draggable="true">'
+    '<span class="part-up">'
+    '<span class="more-or-less"><img class="expand_more active"'
+    ' src="{expand_more}" alt="もっと見る" title="もっと見る"></span><span class="code">{code}</span>'
+    ' _{name}: <span class="quantity">{quantity}</span>'
+    ' ,<span class="usedquantity">{usedquantity}</span>'
+    '</span>'
+)
+# 子を持たない行
+PART_BLOCK_HTML = (
+    '<li id="{id}" class="block-part-list" draggable="true">'
+    '<span class="part-block">'
+    '<span class="more-or-less-dummy"></span><span class="code">{code}</span>'
+    ' _{name}: <span class="quantity">{quantity}</span>'
+    ' ,<span class="usedquantity">{usedquantity}</span>'
+    '</span>'
+    '</li>'
+)
+
+
+@register.simple_tag
 def recursetree(nodes):
-    return {'nodes': nodes}
+    return render_tree(nodes)
+
+
+def render_tree(nodes):
+    """
+    find_by_product_id で組み立てた構成の子のリストを、入れ子の<ul class="nested">のHTMLにする
+    ノード毎にテンプレートを読み込まないよう、スタックを使ってPython上で組み立てます。
+    階層が深い場合でも再帰の上限には掛かりません。
+    :param nodes: 子のノード(id, code, name, quantity, usedquantity, child_count, children)のリスト
+    :return: HTML
+    """
+    expand_more = static('icons/expand_more_black_24dp.svg')
+    html = ['<ul class="nested">']
+    stack = [iter(nodes)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            # この階層の子を全て出力したので、リストと親の行を閉じる。
+            stack.pop()
+            html.append('</ul>')
+            if stack:
+                html.append('</li>')
+            continue
+        if node['children']:
+            html.append(format_html(PART_UP_HTML, expand_more=expand_more, id=node['id'], code=node['code'],
+                                    name=node['name'], quantity=node['quantity'],
+                                    usedquantity=node['usedquantity']))
+            html.append('<ul class="nested">')
+            stack.append(iter(node['children']))
+        elif node.get('child_count'):
+            # 子をまだ読み込んでいない要素。子は展開した時に読み込みます。
+            html.append(format_html(PART_UP_HTML, expand_more=expand_more, id=node['id'], code=node['code'],
+                                    name=node['name'], quantity=node['quantity'],
+                                    usedquantity=node['usedquantity']))
+            html.append('<ul class="nested lazy"></ul></li>')
+        else:
+            html.append(format_html(PART_BLOCK_HTML, id=node['id'], code=node['code'], name=node['name'],
+                                    quantity=node['quantity'], usedquantity=node['usedquantity']))
+    return mark_safe(''.join(html))
@@ -1,3 +1,683 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+from collections import Counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from part_list_app.models import Part, Composition, CompositionChangeSet, CompositionHistory, UndoRedoPointer, \
+    PartAdjacency
+from part_list_app.views import ProductList, find_by_product_id, get_subtree_queryset, get_undo_redo_status, \
+    compact_history, iter_bom_rows, COMPOSITION_ID_CONFLICT_MESSAGE
+
+
+# 構成、構成履歴の取得で使うクエリが、全件走査ではなくインデックスを使う事を確認します。
+# (SQLite の EXPLAIN QUERY PLAN の結果を確認するので、SQLite の場合のみ実行します)
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN は SQLite のみ確認します')
+class QueryPlanTests(TestCase):
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        # 並べ替えもインデックスの順で済む事(一時的なB-Treeを使わない事)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_children_use_parent_sort_index(self):
+        # get_children_map など: 親id毎の子を sort 順に取得
+        self.assertUsesIndex(
+            Composition.objects.filter(parent_id__in=[1, 2, 3]).order_by('parent_id', 'sort'),
+            'composition_parent_sort_idx'
+        )
+        self.assertUsesIndex(
+            Composition.objects.filter(parent_id=1).order_by('sort'),
+            'composition_parent_sort_idx'
+        )
+
+    def test_max_sort_uses_parent_sort_index(self):
+        # 並び順の最大値の取得
+        plan = Composition.objects.filter(parent_id=1).values('parent_id').annotate(
+            max_sort=Max('sort')
+        ).explain()
+        self.assertIn('composition_parent_sort_idx', plan)
+
+    def test_change_sets_use_product_index(self):
+        # 「元に戻す」、「やり直し」の前後の構成変更セットの取得
+        self.assertUsesIndex(
+            CompositionChangeSet.objects.filter(product=1, pk__gt=10).order_by('pk'),
+            'change_set_product_id_idx'
+        )
+        self.assertUsesIndex(
+            CompositionChangeSet.objects.filter(product=1, pk__lt=10).order_by('-pk'),
+            'change_set_product_id_idx'
+        )
+
+    def test_histories_use_change_set_index(self):
+        # 構成変更セットの履歴を pk 順に取得
+        self.assertUsesIndex(
+            CompositionHistory.objects.filter(composition_change_set=1).order_by('pk'),
+            'history_change_set_id_idx'
+        )
+        self.assertUsesIndex(
+            CompositionHistory.objects.filter(composition_change_set=1).order_by('-pk'),
+            'history_change_set_id_idx'
+        )
+
+    def test_part_code_uses_unique_index(self):
+        # 部品コードより部品を検索
+        plan = Part.objects.filter(code='aa').values_list('id', 'name').explain()
+        self.assertIn('SEARCH', plan)
+        self.assertIn('(code=?)', plan)
+
+    def test_product_search_uses_ngram_index(self):
+        # 一覧画面の検索: n-gramで部品を絞り込み、部品と親idのインデックスで製品を取得
+        view = ProductList()
+        view.request = RequestFactory().get('/part_list_app/composition/search/', {'query': '部品'})
+        plan = view.get_queryset().explain()
+        self.assertNotIn('SCAN', plan)
+        self.assertIn('composition_part_parent_idx', plan)
+
+    def test_subtree_uses_path_index(self):
+        # 配下のCompositionを経路の範囲で取得、削除
+        self.assertUsesIndex(get_subtree_queryset('/1/2/'), 'composition_path_idx')
+
+
+# 変更画面の各処理を、画面と同じURLで実行して確認します。
+class CompositionEditTests(TestCase):
+
+    def setUp(self):
+        for code, name in [('pra', '製品a'), ('prb', '製品b'), ('aa', 'アセンブリa'), ('ab', 'アセンブリb'),
+                           ('pa', 'パーツa'), ('pb', 'パーツb')]:
+            Part.objects.create(code=code, name=name)
+        self.product_id = self.get('composition_add_product', edit_block_code='pra')['new_id']
+
+    # 変更画面の処理を実行し、JSONの応答を返す。
+    def get(self, name, product_id=None, **params):
+        args = [] if name == 'composition_add_product' else [product_id or self.product_id]
+        response = self.client.get(reverse(f'part_list_app:{name}', args=args), params,
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def add_child(self, parent_id, code, quantity=1):
+        response = self.get('composition_mod_add_children', current_composition_id=parent_id,
+                            edit_block_code=code, edit_block_quantity=quantity)
+        self.assertTrue(response['success'], response)
+        return response['new_id']
+
+    def rows(self):
+        return sorted(Composition.objects.values_list('id', 'parent_id', 'sort', 'part_id', 'quantity'))
+
+    def pointer_id(self):
+        return UndoRedoPointer.objects.get(product=self.product_id).pointer_id
+
+    def assertInvariants(self):
+        compositions = {row[0]: row for row in Composition.objects.values_list('id', 'parent_id', 'part_id', 'path')}
+        adjacency = Counter()
+        for id, parent_id, part_id, path in compositions.values():
+            if parent_id is None:
+                self.assertEqual(path, f'/{id}/')
+            else:
+                self.assertEqual(path, f'{compositions[parent_id][3]}{id}/')
+                adjacency[(compositions[parent_id][2], part_id)] += 1
+        self.assertEqual(
+            {(parent_part_id, child_part_id): count for parent_part_id, child_part_id, count in
+             PartAdjacency.objects.values_list('parent_part_id', 'child_part_id', 'count')},
+            dict(adjacency)
+        )
+
+    def test_insert_shifts_siblings_once(self):
+        a = self.add_child(self.product_id, 'aa')
+        b = self.add_child(self.product_id, 'ab')
+        response = self.get('composition_mod_add', current_composition_id=b, edit_block_code='pa',
+                            edit_block_quantity=1)
+        self.assertTrue(response['success'], response)
+        self.assertEqual(list(Composition.objects.filter(parent_id=self.product_id).order_by('sort').values_list(
+            'id', 'sort'
+        )), [(a, 1), (response['new_id'], 2), (b, 3)])
+        # 兄弟の並び順のずれは 'shift' の履歴1件で記録される。
+        self.assertEqual(CompositionHistory.objects.filter(action='shift').count(), 1)
+
+    def test_root_target_rejected(self):
+        a = self.add_child(self.product_id, 'aa')
+        rows = self.rows()
+        histories = CompositionHistory.objects.count()
+        for name, params in [
+            ('composition_mod_drop', {'drop_target_id': self.product_id, 'insert_position': 'before',
+                                      'dragged_id': a}),
+            ('composition_mod_drop', {'drop_target_id': a, 'insert_position': 'after',
+                                      'dragged_id': self.product_id}),
+            ('composition_mod_add', {'current_composition_id': self.product_id, 'edit_block_code': 'pa',
+                                     'edit_block_quantity': 1}),
+            ('composition_mod_move', {'source_ids': a, 'target_id': self.product_id, 'insert_position': 'after'}),
+            ('composition_mod_copy', {'source_ids': a, 'target_id': self.product_id, 'insert_position': 'before'}),
+        ]:
+            response = self.get(name, **params)
+            self.assertFalse(response['success'], name)
+            self.assertIn('message', response)
+        self.assertEqual(self.rows(), rows)
+        self.assertEqual(CompositionHistory.objects.count(), histories)
+        self.assertEqual(Composition.objects.filter(parent_id__isnull=True).values_list('sort', flat=True).get(), 1)
+
+    def test_cyclic_composition_rejected(self):
+        a = self.add_child(self.product_id, 'aa')
+        pa = self.add_child(a, 'pa')
+        b = self.add_child(self.product_id, 'ab')
+        c = self.add_child(b, 'aa')
+        self.assertInvariants()
+        rows = self.rows()
+        # 経路上の部品(aa)の追加
+        response = self.get('composition_mod_add_children', current_composition_id=pa, edit_block_code='aa',
+                            edit_block_quantity=1)
+        self.assertEqual(response['message'], '循環参照エラーが発生致しました。')
+        # 配下に経路上の部品(aa)を含む構成の移動
+        response = self.get('composition_mod_drop', drop_target_id=pa, insert_position='after', dragged_id=b)
+        self.assertEqual(response['message'], '循環参照エラーが発生致しました。')
+        self.assertEqual(self.rows(), rows)
+        self.assertInvariants()
+
+        # 部品の隣接関係より循環し得ない事が分かる場合は、配下のCompositionを読まない。
+        with mock.patch('part_list_app.views.get_descendants') as get_descendants:
+            self.assertTrue(self.get('composition_mod_drop', drop_target_id=a, insert_position='before',
+                                     dragged_id=b)['success'])
+            self.add_child(c, 'pb')
+        get_descendants.assert_not_called()
+        self.assertInvariants()
+
+    def test_where_used(self):
+        a = self.add_child(self.product_id, 'aa', 2)
+        b = self.add_child(a, 'ab', 3)
+        pa = self.add_child(b, 'pa', 4)
+        other_product_id = self.get('composition_add_product', edit_block_code='prb')['new_id']
+        other_pa = self.get('composition_mod_add_children', product_id=other_product_id,
+                            current_composition_id=other_product_id, edit_block_code='pa',
+                            edit_block_quantity=5)['new_id']
+
+        def where_used(code):
+            response = self.client.get(reverse('part_list_app:product_where_used'), {'edit_block_code': code})
+            return json.loads(response.content)
+
+        # 数階層下で使用している製品と、直下で使用している製品が返る。
+        response = where_used('pa')
+        self.assertTrue(response['success'])
+        self.assertEqual([(product['id'], product['code'], product['usedquantity'])
+                          for product in response['products']],
+                         [(self.product_id, 'pra', 24), (other_product_id, 'prb', 5)])
+        usage = response['products'][0]['usages'][0]
+        self.assertEqual(usage['id'], pa)
+        self.assertEqual([(row['id'], row['code'], row['quantity']) for row in usage['path']],
+                         [(self.product_id, 'pra', None), (a, 'aa', 2), (b, 'ab', 3), (pa, 'pa', 4)])
+        self.assertEqual(response['products'][1]['usages'][0]['id'], other_pa)
+        # 使用されていない部品
+        self.assertEqual(where_used('pb'), {'success': True, 'products': []})
+        self.assertFalse(where_used('zz')['success'])
+
+    def test_explosion_totals(self):
+        # 同じ部品が複数の親の配下にある場合は、員数を掛け合わせた所要量を合計する。
+        a = self.add_child(self.product_id, 'aa', 2)
+        self.add_child(a, 'pa', 3)
+        self.add_child(a, 'pb', 1)
+        b = self.add_child(self.product_id, 'ab', 4)
+        self.add_child(b, 'pa', 5)
+        self.add_child(self.add_child(b, 'aa', 2), 'pa', 3)
+
+        def explosion(**params):
+            response = self.client.get(reverse('part_list_app:composition_mod_explosion', args=[self.product_id]),
+                                       params)
+            self.assertEqual(response.status_code, 200)
+            return b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertEqual(explosion(), (
+            'code,name,usedquantity\r\n'
+            'aa,アセンブリa,10\r\n'
+            'ab,アセンブリb,4\r\n'
+            'pa,パーツa,50\r\n'
+            'pb,パーツb,2\r\n'
+        ))
+        self.assertEqual([json.loads(line) for line in explosion(format='jsonl').splitlines()], [
+            {'code': 'aa', 'name': 'アセンブリa', 'usedquantity': 10},
+            {'code': 'ab', 'name': 'アセンブリb', 'usedquantity': 4},
+            {'code': 'pa', 'name': 'パーツa', 'usedquantity': 50},
+            {'code': 'pb', 'name': 'パーツb', 'usedquantity': 2},
+        ])
+
+    def test_tree_cache_invalidated(self):
+        a = self.add_child(self.product_id, 'aa', 2)
+
+        def tree():
+            response = self.client.get(reverse('part_list_app:composition_mod', args=[self.product_id]))
+            return [(node['code'], node['name'], node['quantity']) for node in response.context['nodes'][0]['children']]
+
+        self.assertEqual(tree(), [('aa', 'アセンブリa', 2)])
+        # 変更が無ければキャッシュから表示し、構成ツリーを組み立て直さない。
+        with mock.patch('part_list_app.views.find_by_product_id') as find_by_product_id:
+            self.assertEqual(len(self.client.get(
+                reverse('part_list_app:composition_mod', args=[self.product_id])
+            ).context['nodes']), 1)
+        find_by_product_id.assert_not_called()
+        # 変更、元に戻す、部品名の変更はそれぞれ表示に反映される。
+        self.get('composition_mod_mod', current_composition_id=a, edit_block_code='aa', edit_block_quantity=5)
+        self.assertEqual(tree(), [('aa', 'アセンブリa', 5)])
+        self.client.get(reverse('part_list_app:composition_mod_undo', args=[self.product_id]))
+        self.assertEqual(tree(), [('aa', 'アセンブリa', 2)])
+        part = Part.objects.get(code='aa')
+        part.name = 'アセンブリa2'
+        part.save()
+        self.assertEqual(tree(), [('aa', 'アセンブリa2', 2)])
+
+    def test_tree_diff_matches_tree(self):
+        # 画面と同じく、応答の差分(無くなったid、親毎の子の並び、変更された構成)を表示中のツリーへ反映し、
+        # 各処理の後のツリーと一致する事を確認する。
+        def flatten(nodes, parent_id, flat, children):
+            children[parent_id] = [node['id'] for node in nodes]
+            for node in nodes:
+                flat[node['id']] = (node['code'], node['name'], node['quantity'])
+                flatten(node['children'], node['id'], flat, children)
+
+        def build(id, usedquantity):
+            return (id, *flat[id], usedquantity,
+                    [build(child_id, usedquantity * flat[child_id][2]) for child_id in children.get(id, [])])
+
+        def build_expected(node):
+            return (node['id'], node['code'], node['name'], node['quantity'], node['usedquantity'],
+                    [build_expected(child) for child in node['children']])
+
+        def apply(response):
+            diff = response['diff']
+            for id in diff['removed']:
+                flat.pop(id, None)
+                for child_ids in children.values():
+                    if id in child_ids:
+                        child_ids.remove(id)
+            for node in diff['nodes']:
+                flat[node['id']] = (node['code'], node['name'], node['quantity'])
+            for parent_id, child_ids in diff['parents'].items():
+                children[int(parent_id)] = child_ids
+            tree = build_expected(find_by_product_id(self.product_id)[0])
+            self.assertEqual(build(self.product_id, 1), tree)
+            # 変更された構成の実使用数は、ツリーの実使用数と一致する。
+            usedquantities = {}
+            stack = [tree]
+            while stack:
+                id, code, name, quantity, usedquantity, child_rows = stack.pop()
+                usedquantities[id] = usedquantity
+                stack.extend(child_rows)
+            for node in diff['nodes']:
+                self.assertEqual(node['usedquantity'], usedquantities[node['id']])
+            return diff
+
+        flat = {}
+        children = {}
+        flatten(find_by_product_id(self.product_id)[0]['children'], self.product_id, flat, children)
+        flat[self.product_id] = ('pra', '製品a', 1)
+
+        a = apply(self.get('composition_mod_add_children', current_composition_id=self.product_id,
+                           edit_block_code='aa', edit_block_quantity=2))['nodes'][0]['id']
+        b = apply(self.get('composition_mod_add_children', current_composition_id=self.product_id,
+                           edit_block_code='ab', edit_block_quantity=3))['nodes'][0]['id']
+        pa = apply(self.get('composition_mod_add_children', current_composition_id=a, edit_block_code='pa',
+                            edit_block_quantity=4))['nodes'][0]['id']
+        apply(self.get('composition_mod_add', current_composition_id=b, edit_block_code='pb',
+                       edit_block_quantity=1))
+        apply(self.get('composition_mod_mod', current_composition_id=a, edit_block_code='aa',
+                       edit_block_quantity=5))
+        # 移動元と移動先の親の並びが返る。
+        diff = apply(self.get('composition_mod_drop', drop_target_id=pa, insert_position='after', dragged_id=b))
+        self.assertTrue({str(self.product_id), str(a)} <= diff['parents'].keys())
+        diff = apply(self.get('composition_mod_del', current_composition_id=a))
+        self.assertIn(b, diff['removed'])
+        apply(self.get('composition_mod_undo'))
+        apply(self.get('composition_mod_undo'))
+        apply(self.get('composition_mod_redo'))
+
+    def test_lazy_children(self):
+        a = self.add_child(self.product_id, 'aa', 2)
+        b = self.add_child(a, 'ab', 3)
+        self.add_child(b, 'pa', 4)
+        other_product_id = self.get('composition_add_product', edit_block_code='prb')['new_id']
+
+        def children(url_params):
+            return self.client.get(reverse('part_list_app:composition_mod', args=[self.product_id]),
+                                   url_params).context['nodes'][0]['children']
+
+        # 既定では全階層を読み込む。
+        self.assertEqual(children({})[0]['children'][0]['children'][0]['code'], 'pa')
+        # 指定した階層より深い階層は、子の件数のみを返す。
+        node = children({'depth': 1})[0]
+        self.assertEqual((node['id'], node['child_count'], node['children']), (a, 1, []))
+
+        response = self.get('composition_mod_children', current_composition_id=a)
+        self.assertEqual(response, {'exists': True, 'nodes': [
+            {'id': b, 'code': 'ab', 'name': 'アセンブリb', 'quantity': 3, 'usedquantity': 6, 'child_count': 1}
+        ]})
+        # 他の製品の構成、存在しないid、数値でないidは読み込まない。
+        for current_composition_id in [other_product_id, 9999, 'abc', '']:
+            self.assertEqual(self.get('composition_mod_children', current_composition_id=current_composition_id),
+                             {'exists': False})
+        self.assertEqual(self.get('composition_mod_children'), {'exists': False})
+        self.assertFalse(self.get('composition_mod_children', product_id=other_product_id,
+                                  current_composition_id=a)['exists'])
+
+    def test_undo_stops_at_product_creation(self):
+        self.add_child(self.product_id, 'aa')
+        created_rows = [row for row in self.rows() if row[0] == self.product_id]
+        response = self.get('composition_mod_undo')
+        self.assertEqual((response['undo'], response['redo']), (False, True))
+        self.assertEqual(self.rows(), created_rows)
+        # 製品の作成は元に戻さず、製品は削除されない。
+        response = self.get('composition_mod_undo')
+        self.assertEqual((response['undo'], response['redo']), (False, True))
+        self.assertEqual(self.rows(), created_rows)
+        # 判定は UndoRedoPointer のみで行い、クエリを発行しない。
+        undo_redo_pointer = UndoRedoPointer.objects.get(product=self.product_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_undo_redo_status(undo_redo_pointer), (False, True))
+        response = self.get('composition_mod_redo')
+        self.assertEqual((response['undo'], response['redo']), (True, False))
+        self.assertEqual(len(self.rows()), 2)
+
+    def test_undo_redo_restore_rows(self):
+        snapshots = {self.pointer_id(): self.rows()}
+        a = self.add_child(self.product_id, 'aa', 2)
+        snapshots[self.pointer_id()] = self.rows()
+        b = self.add_child(self.product_id, 'ab', 3)
+        snapshots[self.pointer_id()] = self.rows()
+        self.add_child(a, 'pa', 4)
+        snapshots[self.pointer_id()] = self.rows()
+        self.assertTrue(self.get('composition_mod_drop', drop_target_id=a, insert_position='before',
+                                 dragged_id=b)['success'])
+        snapshots[self.pointer_id()] = self.rows()
+        self.assertTrue(self.get('composition_mod_mod', current_composition_id=a, edit_block_code='aa',
+                                 edit_block_quantity=5)['exists'])
+        snapshots[self.pointer_id()] = self.rows()
+        self.assertTrue(self.get('composition_mod_del', current_composition_id=a)['exists'])
+        snapshots[self.pointer_id()] = self.rows()
+        self.assertInvariants()
+        change_set_ids = sorted(snapshots)
+
+        # 1つずつ元に戻し、製品の作成で止まる事
+        for change_set_id in reversed(change_set_ids[:-1]):
+            response = self.get('composition_mod_undo')
+            self.assertEqual(self.pointer_id(), change_set_id)
+            self.assertEqual(self.rows(), snapshots[change_set_id])
+            self.assertInvariants()
+        self.assertFalse(response['undo'])
+        self.assertTrue(response['redo'])
+
+        # 1つずつやり直す
+        for change_set_id in change_set_ids[1:]:
+            response = self.get('composition_mod_redo')
+            self.assertEqual(self.pointer_id(), change_set_id)
+            self.assertEqual(self.rows(), snapshots[change_set_id])
+            self.assertInvariants()
+        self.assertFalse(response['redo'])
+
+    def test_jump_restores_rows(self):
+        snapshots = {self.pointer_id(): self.rows()}
+        a = self.add_child(self.product_id, 'aa', 2)
+        snapshots[self.pointer_id()] = self.rows()
+        b = self.add_child(self.product_id, 'ab', 3)
+        snapshots[self.pointer_id()] = self.rows()
+        self.add_child(a, 'pa', 4)
+        snapshots[self.pointer_id()] = self.rows()
+        self.get('composition_mod_drop', drop_target_id=a, insert_position='before', dragged_id=b)
+        snapshots[self.pointer_id()] = self.rows()
+        self.get('composition_mod_del', current_composition_id=a)
+        snapshots[self.pointer_id()] = self.rows()
+        change_set_ids = sorted(snapshots)
+
+        # 指定した構成変更セット、指定した数へまとめて移動する
+        response = self.get('composition_mod_jump', change_set_id=change_set_ids[1])
+        self.assertTrue(response['success'])
+        self.assertEqual(self.rows(), snapshots[change_set_ids[1]])
+        self.assertInvariants()
+        self.get('composition_mod_jump', steps=2)
+        self.assertEqual(self.rows(), snapshots[change_set_ids[3]])
+        self.assertInvariants()
+        # 戻し過ぎても製品の作成で止まり、製品は削除されない事
+        response = self.get('composition_mod_jump', steps=-100)
+        self.assertEqual(self.pointer_id(), change_set_ids[0])
+        self.assertEqual(self.rows(), snapshots[change_set_ids[0]])
+        self.assertFalse(response['undo'])
+        self.get('composition_mod_jump', change_set_id='')
+        self.assertEqual(self.pointer_id(), change_set_ids[0])
+        self.assertEqual(self.rows(), snapshots[change_set_ids[0]])
+        self.get('composition_mod_jump', steps=100)
+        self.assertEqual(self.rows(), snapshots[change_set_ids[-1]])
+        self.assertInvariants()
+        self.assertFalse(self.get('composition_mod_jump', change_set_id='abc')['success'])
+
+    def test_compact_history(self):
+        a = self.add_child(self.product_id, 'aa', 2)
+        for quantity in [3, 3, 4, 5]:
+            self.get('composition_mod_mod', current_composition_id=a, edit_block_code='aa',
+                     edit_block_quantity=quantity)
+        rows = self.rows()
+        # 値の変わらない変更(3→3)の構成変更セットは、履歴の組と共に削除される。
+        change_set_count, history_count = compact_history(self.product_id, retention=10)
+        self.assertEqual((change_set_count, history_count), (1, 2))
+        self.assertEqual(CompositionChangeSet.objects.filter(product=self.product_id).count(), 5)
+        # 保持する件数より古い構成変更セット(製品の作成を含む)を削除する。
+        change_set_count, history_count = compact_history(self.product_id, retention=2)
+        self.assertEqual(change_set_count, 3)
+        self.assertEqual(CompositionChangeSet.objects.filter(product=self.product_id).count(), 2)
+        self.assertEqual(self.rows(), rows)
+        # 残した2件だけ元に戻せる。
+        self.assertTrue(self.get('composition_mod_undo')['undo'])
+        self.assertFalse(self.get('composition_mod_undo')['undo'])
+        self.assertEqual(Composition.objects.get(pk=a).quantity, 3)
+        self.assertInvariants()
+
+    def test_product_search(self):
+        other_product_id = self.get('composition_add_product', edit_block_code='prb')['new_id']
+        self.add_child(self.product_id, 'aa')
+
+        def search(query):
+            response = self.client.get(reverse('part_list_app:product_search'), {'query': query})
+            return sorted(composition.id for composition in response.context['compositions'])
+
+        # 部品コードは大文字、小文字を区別しない。
+        self.assertEqual(search('PRA'), [self.product_id])
+        # 1文字の検索
+        self.assertEqual(search('b'), [other_product_id])
+        # 部品名の日本語の部分一致
+        self.assertEqual(search('品a'), [self.product_id])
+        self.assertEqual(search('製品'), [self.product_id, other_product_id])
+        # 製品でない構成の部品や、離れた位置の文字だけが一致する部品は返さない。
+        self.assertEqual(search('aa'), [])
+        self.assertEqual(search('製a'), [])
+        self.assertEqual(search(''), [self.product_id, other_product_id])
+        # 部品名を変更すると、新しい部品名で検索出来る。
+        part = Part.objects.get(code='prb')
+        part.name = '試作品'
+        part.save()
+        self.assertEqual(search('試作'), [other_product_id])
+        self.assertEqual(search('製品'), [self.product_id])
+
+    def test_clone_product(self):
+        a = self.add_child(self.product_id, 'aa', 2)
+        self.add_child(a, 'pa', 3)
+        response = self.get('composition_mod_clone', edit_block_code='prb')
+        self.assertTrue(response['success'], response)
+        new_id = response['new_id']
+        self.assertEqual(list(iter_bom_rows(new_id))[1:], list(iter_bom_rows(self.product_id))[1:])
+        # 複製した製品の作成は元に戻せない。
+        self.assertFalse(response['undo'])
+        self.assertFalse(self.get('composition_mod_undo', new_id)['undo'])
+        self.assertTrue(Composition.objects.filter(pk=new_id).exists())
+        self.assertInvariants()
+        # 複製先の製品の部品が配下にある場合は循環参照となる。
+        response = self.get('composition_mod_clone', edit_block_code='pa')
+        self.assertFalse(response['success'])
+        # 採番したidが他の処理と重なった場合は、何も登録せずにやり直しを求める。
+        rows = self.rows()
+        with mock.patch('part_list_app.views.get_next_composition_id', return_value=new_id):
+            response = self.get('composition_mod_clone', edit_block_code='prb')
+        self.assertEqual(response['message'], COMPOSITION_ID_CONFLICT_MESSAGE)
+        self.assertEqual(self.rows(), rows)
+
+    def test_move_and_copy_subtrees(self):
+        a = self.add_child(self.product_id, 'aa')
+        pa = self.add_child(a, 'pa', 2)
+        b = self.add_child(self.product_id, 'ab')
+        pb = self.add_child(b, 'pb', 3)
+        before = self.rows()
+
+        # 選択した構成の配下も選択されている場合は、頂点と一緒に1回だけ複写される。
+        response = self.get('composition_mod_copy', source_ids=f'{a},{pa}', target_id=b, insert_position='children')
+        self.assertTrue(response['success'], response)
+        copied = Composition.objects.filter(parent_id=b).order_by('sort').values_list('id', 'part__code', 'quantity')
+        self.assertEqual([(code, quantity) for id, code, quantity in copied], [('pb', 3), ('aa', 1)])
+        copy_id = copied[1][0]
+        self.assertEqual(list(Composition.objects.filter(parent_id=copy_id).values_list('part__code', 'quantity')),
+                         [('pa', 2)])
+        self.assertInvariants()
+        after_copy = self.rows()
+        # 採番したidが他の処理と重なった場合は、何も登録せずにやり直しを求める。
+        with mock.patch('part_list_app.views.get_next_composition_id', return_value=copy_id):
+            response = self.get('composition_mod_copy', source_ids=a, target_id=b, insert_position='children')
+        self.assertEqual(response['message'], COMPOSITION_ID_CONFLICT_MESSAGE)
+        self.assertEqual(self.rows(), after_copy)
+
+        # 複数の構成を指定した順に、まとめて移動する。
+        response = self.get('composition_mod_move', source_ids=f'{pb},{pa}', target_id=a,
+                            insert_position='before')
+        self.assertTrue(response['success'], response)
+        self.assertEqual(list(Composition.objects.filter(parent_id=self.product_id).order_by('sort').values_list(
+            'id', flat=True
+        )), [pb, pa, a, b])
+        self.assertInvariants()
+
+        # 移動、複写はそれぞれ1回の「元に戻す」で戻る。
+        self.get('composition_mod_undo')
+        self.assertEqual(self.rows(), after_copy)
+        self.get('composition_mod_undo')
+        self.assertEqual(self.rows(), before)
+        self.assertInvariants()
+
+    def test_cyclic_move_rejected(self):
+        a = self.add_child(self.product_id, 'aa')
+        pa = self.add_child(a, 'pa')
+        b = self.add_child(self.product_id, 'aa')
+        rows = self.rows()
+        # 自身の配下への移動
+        response = self.get('composition_mod_move', source_ids=a, target_id=pa, insert_position='children')
+        self.assertEqual(response['message'], '循環参照エラーが発生致しました。')
+        # 同じ部品(aa)の配下への移動
+        response = self.get('composition_mod_move', source_ids=b, target_id=a, insert_position='children')
+        self.assertEqual(response['message'], '循環参照エラーが発生致しました。')
+        self.assertEqual(self.rows(), rows)
+        self.assertInvariants()
+
+
+# import_bom で読み込んだ構成が部品表の通りに登録され、export_bom で同じ構成表に戻る事を確認します。
+class BomCommandTests(TestCase):
+
+    BOM_CSV = (
+        'level,code,quantity\n'
+        '0,pra,\n'
+        '1,aa,2\n'
+        '2,pa,3\n'
+        '2,pb,1\n'
+        '1,ab,4\n'
+        '2,pa,5\n'
+    )
+
+    EXPECTED_TREE = ('pra', [
+        ('aa', 2, [('pa', 3, []), ('pb', 1, [])]),
+        ('ab', 4, [('pa', 5, [])]),
+    ])
+
+    def setUp(self):
+        for code in ['pra', 'prb', 'aa', 'ab', 'pa', 'pb']:
+            Part.objects.create(code=code, name=f'部品{code}')
+
+    def import_bom(self, content, suffix='.csv', *args):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, encoding='utf-8', delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        call_command('import_bom', file.name, *args, stdout=io.StringIO())
+
+    def export_bom(self, *args):
+        stdout = io.StringIO()
+        call_command('export_bom', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    # 製品の構成を (部品コード, [(部品コード, 数, 子の一覧)]) の形で返す。
+    def tree(self, product_id):
+        def children(parent_id):
+            return [
+                (composition.part.code, composition.quantity, children(composition.id))
+                for composition in Composition.objects.filter(parent_id=parent_id).order_by('sort')
+            ]
+        return Composition.objects.get(pk=product_id).part.code, children(product_id)
+
+    def assertPaths(self):
+        for id, parent_id, path in Composition.objects.values_list('id', 'parent_id', 'path'):
+            parent_path = Composition.objects.get(pk=parent_id).path if parent_id else '/'
+            self.assertEqual(path, f'{parent_path}{id}/')
+
+    def test_import_indented(self):
+        self.import_bom(self.BOM_CSV)
+        product_id = Composition.objects.get(parent_id__isnull=True).id
+        self.assertEqual(self.tree(product_id), self.EXPECTED_TREE)
+        self.assertPaths()
+        self.assertEqual(PartAdjacency.objects.get(parent_part__code='aa', child_part__code='pa').count, 1)
+        self.assertEqual(PartAdjacency.objects.get(parent_part__code='pra', child_part__code='aa').count, 1)
+        # JSON Lines でも同じ構成になる。
+        self.import_bom(''.join(json.dumps(row) + '\n' for row in [
+            {'level': 0, 'code': 'pra'}, {'level': 1, 'code': 'aa', 'quantity': 2},
+            {'level': 2, 'code': 'pa', 'quantity': 3}, {'level': 2, 'code': 'pb', 'quantity': 1},
+            {'level': 1, 'code': 'ab', 'quantity': 4}, {'level': 2, 'code': 'pa', 'quantity': 5},
+        ]), '.jsonl')
+        new_product_id = Composition.objects.filter(parent_id__isnull=True).exclude(pk=product_id).get().id
+        self.assertEqual(self.tree(new_product_id), self.EXPECTED_TREE)
+        self.assertEqual(PartAdjacency.objects.get(parent_part__code='aa', child_part__code='pa').count, 2)
+
+    def test_import_parent_layout(self):
+        self.import_bom(
+            'parent_code,code,quantity\npra,aa,2\npra,ab,4\naa,pa,3\naa,pb,1\nab,pa,5\n',
+            '.csv', '--layout', 'parent'
+        )
+        product_id = Composition.objects.get(parent_id__isnull=True).id
+        self.assertEqual(self.tree(product_id), self.EXPECTED_TREE)
+        self.assertPaths()
+
+    def test_import_export_round_trip(self):
+        self.import_bom(self.BOM_CSV)
+        product_id = Composition.objects.get(parent_id__isnull=True).id
+        exported = self.export_bom('--product', str(product_id))
+        self.assertEqual(exported.replace('\r\n', '\n'), (
+            'level,code,name,quantity,usedquantity\n'
+            '0,pra,部品pra,1,1\n'
+            '1,aa,部品aa,2,2\n'
+            '2,pa,部品pa,3,6\n'
+            '2,pb,部品pb,1,2\n'
+            '1,ab,部品ab,4,4\n'
+            '2,pa,部品pa,5,20\n'
+        ))
+        # 出力した構成表を読み込み直しても、同じ構成表になる。
+        self.import_bom(exported)
+        new_product_id = Composition.objects.filter(parent_id__isnull=True).exclude(pk=product_id).get().id
+        self.assertEqual(self.export_bom('--product', str(new_product_id)), exported)
+        # JSON Lines で出力して読み込み直しても、同じ構成になる。
+        self.import_bom(self.export_bom('--product', str(product_id), '--format', 'jsonl'), '.jsonl')
+        self.assertEqual(Composition.objects.filter(parent_id__isnull=True).count(), 3)
+        self.assertEqual(len({
+            tuple(row[1:] for row in iter_bom_rows(id))
+            for id in Composition.objects.filter(parent_id__isnull=True).values_list('id', flat=True)
+        }), 1)
+
+    def test_import_rejects_cyclic_parts(self):
+        with self.assertRaises(CommandError):
+            self.import_bom('level,code,quantity\n0,pra,\n1,aa,1\n2,aa,1\n')
+        with self.assertRaises(CommandError):
+            self.import_bom('parent_code,code,quantity\npra,aa,1\naa,ab,1\nab,aa,1\n', '.csv', '--layout', 'parent')
+        self.assertFalse(Composition.objects.exists())
+        self.assertFalse(PartAdjacency.objects.exists())
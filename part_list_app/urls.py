@@ -8,7 +8,10 @@ urlpatterns = [
          name='product_list'),   # 一覧
     path('composition/search/', views.ProductList.as_view(),
          name='product_search'),   # 検索
+    path('composition/where-used/', views.product_where_used,
+         name='product_where_used'),   # 使用先検索
     path('composition/del/', views.product_del, name='product_del'),   # 削除
+    path('composition/export/', views.composition_export, name='product_export'),   # 構成表の出力
 
     # 構成を追加画面
     path('composition/add/', views.composition_edit,
@@ -30,6 +33,16 @@ urlpatterns = [
          name='composition_add_undo'),  # 元に戻す
     path('composition/add/<int:product_id>/redo/', views.composition_edit_redo,
          name='composition_add_redo'),  # やり直し
+    path('composition/add/<int:product_id>/jump/', views.composition_edit_jump,
+         name='composition_add_jump'),  # 指定した構成変更セットまで元に戻す、やり直し
+    path('composition/add/<int:product_id>/children/', views.composition_edit_children,
+         name='composition_add_children'),  # 子の読み込み
+    path('composition/add/<int:product_id>/clone/', views.composition_edit_clone,
+         name='composition_add_clone'),  # 製品の複製
+    path('composition/add/<int:product_id>/move/', views.composition_edit_move,
+         name='composition_add_move'),  # 複数選択した構成の移動
+    path('composition/add/<int:product_id>/copy/', views.composition_edit_copy,
+         name='composition_add_copy'),  # 複数選択した構成の複写
 
     # 構成を変更画面
     path('composition/mod/<int:product_id>/', views.composition_edit,
@@ -49,5 +62,19 @@ urlpatterns = [
          name='composition_mod_undo'),  # 元に戻す
     path('composition/mod/<int:product_id>/redo/', views.composition_edit_redo,
          name='composition_mod_redo'),  # やり直し
+    path('composition/mod/<int:product_id>/jump/', views.composition_edit_jump,
+         name='composition_mod_jump'),  # 指定した構成変更セットまで元に戻す、やり直し
+    path('composition/mod/<int:product_id>/children/', views.composition_edit_children,
+         name='composition_mod_children'),  # 子の読み込み
+    path('composition/mod/<int:product_id>/clone/', views.composition_edit_clone,
+         name='composition_mod_clone'),  # 製品の複製
+    path('composition/mod/<int:product_id>/move/', views.composition_edit_move,
+         name='composition_mod_move'),  # 複数選択した構成の移動
+    path('composition/mod/<int:product_id>/copy/', views.composition_edit_copy,
+         name='composition_mod_copy'),  # 複数選択した構成の複写
+    path('composition/mod/<int:product_id>/explosion/', views.composition_explosion,
+         name='composition_mod_explosion'),  # 部品展開(所要量集計)
+    path('composition/mod/<int:product_id>/export/', views.composition_export,
+         name='composition_mod_export'),  # 構成表の出力
 
 ]
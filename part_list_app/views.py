@@ -1,13 +1,33 @@
 from django.shortcuts import render
 from django.views.generic.list import ListView
 from django.db.models import Q
-from part_list_app.models import Composition, Part, CompositionChangeSet, CompositionHistory, UndoRedoPointer
+from part_list_app.models import Composition, Part, CompositionChangeSet, CompositionHistory, UndoRedoPointer, \
+    PartAdjacency, PartNgram
 # from django.http import HttpRequest
-from django.http import JsonResponse
-from django.db.models import Max
-from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Min, Max, F, Count, Value
+from django.db.models.functions import Concat, Substr
+from django.db import connection, transaction, IntegrityError
+from django.core.management.color import no_style
+from django.core.cache import cache
+from django.utils import timezone
 from django.http import HttpResponseRedirect
 from django.urls import reverse
+from django.conf import settings
+from collections import Counter
+import csv
+import json
+import logging
+import time
+import uuid
+
+# 1回のクエリの id__in に渡すidの最大件数(SQLiteの変数の上限を考慮)
+QUERY_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+# 部品の世代のキー(部品コードのキャッシュと、部品を含む構成ツリーのキャッシュを部品の変更で無効にする為に使います)
+PART_GENERATION_KEY = 'part_list_app:part_generation'
 
 
 class ProductList(ListView):
@@ -27,7 +47,8 @@ class ProductList(ListView):
 
         query = self.request.GET.get('query')
         if query is not None and query != '':
-            queryset = queryset.filter(
+            # n-gramのインデックスで候補の部品に絞り込んでから、部分一致を確認する。
+            queryset = queryset.filter(part_id__in=search_part_ids(query)).filter(
                 Q(part__name__icontains=query) |
                 Q(part__code__icontains=query)
             )
@@ -40,13 +61,48 @@ class ProductList(ListView):
         return context
 
 
+# 部品コード、部品名を検索用に区切った n-gram(小文字にした1文字と連続する2文字)の集合を返す。
+def get_part_ngrams(part):
+    ngrams = set()
+    for text in (part.code, part.name):
+        text = (text or '').lower()
+        ngrams.update(text)
+        ngrams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return ngrams
+
+
+# 検索文字列の n-gram を全て持つ部品のidのクエリセットを返す。
+# 部分一致する部品は必ず含まれますが、n-gramが離れた位置にある部品も含むので、部分一致は別途確認して下さい。
+def search_part_ids(query):
+    query = query.lower()
+    ngrams = {query[i:i + 2] for i in range(len(query) - 1)} or {query}
+    return PartNgram.objects.filter(ngram__in=ngrams).values('part_id').annotate(
+        ngram_count=Count('id')
+    ).filter(ngram_count=len(ngrams)).values('part_id')
+
+
+# 部品の検索用の n-gram を作り直す。Part の post_save のシグナルより呼び出します。(apps.py)
+def update_part_ngrams(sender=None, instance=None, **kwargs):
+    rebuild_part_ngrams([instance])
+
+
+# 部品の検索用の n-gram をまとめて作り直す。
+# シグナルの発生しない bulk_create、update などで部品を登録、変更した場合は直接呼び出して下さい。
+def rebuild_part_ngrams(parts):
+    for chunk in chunked([part.id for part in parts]):
+        PartNgram.objects.filter(part_id__in=chunk).delete()
+    PartNgram.objects.bulk_create([
+        PartNgram(part_id=part.id, ngram=ngram) for part in parts for ngram in get_part_ngrams(part)
+    ], batch_size=QUERY_CHUNK_SIZE)
+
+
 def composition_edit(request, product_id=None):
     if product_id is None:
         nodes = None
         title = '構成を追加'
     else:
         # 実行
-        nodes = find_by_product_id(product_id)
+        nodes = get_product_nodes(product_id, get_initial_depth(request))
         title = '構成を変更'
 
     undo_status, redo_status = check_undo_redo(product_id)
@@ -56,20 +112,125 @@ def composition_edit(request, product_id=None):
                   )
 
 
-def get_children(id, quantity):
-    compositions = Composition.objects.filter(parent_id=id).order_by('sort')
+# idのリストを QUERY_CHUNK_SIZE 件ずつに分割する。
+def chunked(ids, size=QUERY_CHUNK_SIZE):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+# 指定したidの配下のCompositionを階層毎にまとめて取得し、親id毎の子のリスト(sort順)を返す。
+# 1階層につき1回(件数が多い場合は QUERY_CHUNK_SIZE 件毎)のクエリで済むので、
+# クエリ数はノード数ではなく階層の深さに比例します。
+# max_depthを指定した場合は、その階層までを取得します。
+# 全階層を取得する場合は、経路(path)の範囲検索1回で配下をまとめて取得します。
+def get_children_map(id, max_depth=None):
+    children_map = {}
+    if max_depth is None:
+        path = Composition.objects.filter(pk=id).values_list('path', flat=True).first()
+        if path is not None:
+            compositions = get_subtree_queryset(path).exclude(pk=id).select_related('part').order_by(
+                'parent_id', 'sort'
+            )
+            for composition in compositions:
+                children_map.setdefault(composition.parent_id, []).append(composition)
+            return children_map
+    parent_ids = [id]
+    depth = 0
+    while parent_ids and (max_depth is None or depth < max_depth):
+        depth += 1
+        next_parent_ids = []
+        for chunk in chunked(parent_ids):
+            compositions = Composition.objects.filter(
+                parent_id__in=chunk
+            ).select_related('part').order_by('parent_id', 'sort')
+            for composition in compositions:
+                children_map.setdefault(composition.parent_id, []).append(composition)
+                next_parent_ids.append(composition.id)
+        parent_ids = next_parent_ids
+    return children_map
+
+
+# get_children_mapで取得済みのデータから階層構造を組み立てる。
+# 階層が深い場合に再帰の上限に掛からないよう、スタックを使って処理します。
+# 子を読み込んでいない要素の子の件数は、child_countsより設定します。
+def get_children(id, quantity, children_map, child_counts=None):
+    child_counts = child_counts or {}
     children = []
+    stack = [(id, quantity, children)]
+    while stack:
+        parent_id, parent_quantity, siblings = stack.pop()
+        for composition in children_map.get(parent_id, []):
+            child = {
+                'id': composition.id,
+                'code': composition.part.code,
+                'name': composition.part.name,
+                'quantity': composition.quantity,
+                'usedquantity': parent_quantity * composition.quantity,
+                'child_count': len(children_map.get(composition.id, [])) or child_counts.get(composition.id, 0),
+                'children': []
+            }
+            siblings.append(child)
+            stack.append((composition.id, child['usedquantity'], child['children']))
+    return children
+
+
+# 指定したidのCompositionの子の件数を、id→件数の辞書で返す。(子が無いidは含まれません)
+def get_child_counts(ids):
+    child_counts = {}
+    ids = list(ids)
+    for chunk in chunked(ids):
+        child_counts.update(
+            Composition.objects.filter(parent_id__in=chunk).order_by().values(
+                'parent_id'
+            ).annotate(count=Count('id')).values_list('parent_id', 'count')
+        )
+    return child_counts
+
+
+# 変更画面で最初に読み込む階層の深さを返す。
+# ?depth= で指定が無ければ設定の PART_LIST_INITIAL_DEPTH(未設定の場合は全階層)とします。
+def get_initial_depth(request):
+    depth = getattr(settings, 'PART_LIST_INITIAL_DEPTH', None)
+    try:
+        depth = int(request.GET.get('depth', depth))
+    except (TypeError, ValueError):
+        return depth
+    return max(depth, 1)
+
+
+# 変更画面の子の読み込み処理(折りたたまれた要素を展開した時に呼ばれる)
+def composition_edit_children(request, product_id):
+    # エラーチェック
+    try:
+        current_composition_id = int(request.GET.get("current_composition_id"))
+    except (TypeError, ValueError):
+        return JsonResponse({"exists": False})
+    # 指定された製品の構成である事は、経路(path)の前方一致で確かめる。
+    rows = {}
+    for row in Composition.objects.filter(
+        pk=current_composition_id, path__startswith=f'/{product_id}/'
+    ).values_list(*COMPOSITION_ROW_FIELDS):
+        rows[row[0]] = row
+    if not rows:
+        return JsonResponse({"exists": False})
+    # 実行
+    load_ancestor_rows(rows)
+    parent_usedquantity = get_usedquantities(rows, [current_composition_id])[current_composition_id]
+    compositions = list(Composition.objects.filter(
+        parent_id=current_composition_id
+    ).select_related('part').order_by('sort'))
+    child_counts = get_child_counts([composition.id for composition in compositions])
+    nodes = []
     for composition in compositions:
-        child = {
+        nodes.append({
             'id': composition.id,
             'code': composition.part.code,
             'name': composition.part.name,
             'quantity': composition.quantity,
-            'usedquantity': quantity * composition.quantity,
-            'children': get_children(composition.id, quantity * composition.quantity)
-        }
-        children.append(child)
-    return children
+            'usedquantity': parent_usedquantity * composition.quantity,
+            'child_count': child_counts.get(composition.id, 0)
+        })
+    return JsonResponse({"exists": True, "nodes": nodes})
 
 
 # 変更画面の削除処理
@@ -87,101 +248,540 @@ def composition_edit_del(request, product_id):
             if product_id == current_composition_id_int:
                 # 選択行のインスタンスを取得
                 current_composition = Composition.objects.get(pk=current_composition_id)
-                # 選択された行のidの子を取得する。
-                children_data = delete_childrens(current_composition.id)
-                # 取得された子のデータをフラットにしてならべる
-                all_children = get_all_children(children_data)
-                # 全ての子を削除する
-                for child in all_children:
-                    child_composition = Composition.objects.get(pk=child['id'])
-                    child_composition.delete()
-                current_composition.delete()
+                # 選択された行とその子を全て削除する
+                delete_subtree(current_composition)
+                invalidate_tree_cache(current_composition.id)
                 return JsonResponse({"exists": exists})
             else:
-                # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新する。
-                update_history_from_pointer(product_id)
-                # 新しい CompositionChangeSet インスタンスを作成
-                composition = Composition.objects.get(id=product_id)
-                composition_change_set = CompositionChangeSet.objects.create(product=composition)
+                # 新しい CompositionChangeSet の記録を開始
+                recorder = CompositionChangeRecorder.start(product_id)
                 # 選択行のインスタンスを取得
                 current_composition = Composition.objects.get(pk=current_composition_id)
-                # 選択された行のidの子を取得する。
-                children_data = delete_childrens(current_composition.id)
-                # 取得された子のデータをフラットにしてならべる
-                all_children = get_all_children(children_data)
-                # 全ての子を削除する
-                for child in all_children:
-                    # Composition.objects.get(pk=child['id']).delete()
-                    child_composition = Composition.objects.get(pk=child['id'])
-                    # child_composition.delete()の実行後にHistoryに書き込むとpk(id)などの値がNoneとなってしまう
-                    # 為、実行順序を1.Historyへの書き込み、2.child_composition.delete()の実行へ変えました。
-                    CompositionHistory.objects.create(
-                        composition_change_set=composition_change_set,
-                        composition_original_id=child_composition.id,
-                        parent_original_id=child_composition.parent_id,
-                        sort=child_composition.sort,
-                        part=child_composition.part,
-                        quantity=child_composition.quantity,
-                        action='delete',
-                        status='before'
-                    )
-                    child_composition.delete()
-                # current_composition.delete()の実行後にHistoryに書き込むとpk(id)などの値が
-                # Noneとなってしまう為、実行順序を1.Historyへの書き込み、2.composition.delete()の
-                # 実行へ変えました。
-                CompositionHistory.objects.create(
-                    composition_change_set=composition_change_set,
-                    composition_original_id=current_composition.id,
-                    parent_original_id=current_composition.parent_id,
-                    sort=current_composition.sort,
-                    part=current_composition.part,
-                    quantity=current_composition.quantity,
-                    action='delete',
-                    status='before'
-                )
-                current_composition.delete()
-
-                # 指定したproductのUndoRedoPointerオブジェクトを取得
-                pointer, created = UndoRedoPointer.objects.get_or_create(
-                    product=composition,
-                    defaults={
-                        'pointer': composition_change_set
-                    }
-                )
-                # すでに存在する場合は、pointer_idを更新
-                if not created:
-                    pointer.pointer = composition_change_set
-                    pointer.save()
-                undo_status, redo_status = check_undo_redo(product_id)
-                return JsonResponse({"exists": exists, 'undo': undo_status, 'redo': redo_status})
+                # 選択された行とその子を全て削除し、削除前の値をHistoryへまとめて書き込む
+                recorder.delete_subtree(current_composition)
+                diff = get_tree_diff(recorder.flush())
+                undo_status, redo_status = recorder.undo_redo_status()
+                return JsonResponse({"exists": exists, 'undo': undo_status, 'redo': redo_status, 'diff': diff})
     else:
         exists = False
         return JsonResponse({"exists": exists})
 
 
-# 削除対象のidを格納する。
-def delete_childrens(id):
-    child_compositions = Composition.objects.filter(parent_id=id)
-    children = []
-    for child_composition in child_compositions:
-        child = {
-            'id': child_composition.id,
-            'part_id': child_composition.part_id,
-            'children': delete_childrens(child_composition.id)
-        }
-        children.append(child)
-    return children
+# 指定したidの配下の全てのCompositionを階層順のフラットなリストで返す。
+def get_descendants(id):
+    children_map = get_children_map(id)
+    return [child for children in children_map.values() for child in children]
+
+
+# 指定したCompositionとその配下を全て削除する。
+# 配下のidは階層毎にまとめて取得し、削除も QUERY_CHUNK_SIZE 件毎にまとめて実行するので、
+# 発行するクエリ数はノード数ではなく階層の深さに比例します。
+# recorderが指定された場合は、削除前の値を'delete'の履歴として記録します。
+def delete_subtree(composition, recorder=None):
+    descendants = get_descendants(composition.id)
+    if recorder is not None:
+        # 削除の実行後にHistoryに書き込むとpk(id)などの値がNoneとなってしまう為、
+        # 削除の実行前に値を記録します。
+        for target in descendants + [composition]:
+            recorder.snapshot(target, 'delete', 'before')
+    else:
+        # 履歴を残さない場合はここで部品の隣接関係を更新する。
+        # (履歴を残す場合は recorder.flush() にて履歴より更新します)
+        update_part_adjacency(
+            [(descendant.parent_id, descendant.part_id, -1) for descendant in descendants],
+            {target.id: target.part_id for target in descendants + [composition]}
+        )
+    if composition.path is not None:
+        # 配下は経路の範囲でまとめて削除する。
+        get_subtree_queryset(composition.path).exclude(pk=composition.id).delete()
+    else:
+        for chunk in chunked([descendant.id for descendant in descendants]):
+            Composition.objects.filter(id__in=chunk).delete()
+    composition.delete()
 
 
-# 階層構造リストをフラットにする。
-def get_all_children(data):
-    all_children = []
+# 次に採番するCompositionのidを返す。
+# 既存のCompositionと、構成履歴より「元に戻す」、「やり直し」で作り直す可能性のあるidより後ろから採番します。
+# idを明示して登録した後は reset_composition_sequence でシーケンスを合わせて下さい。
+# 同時に採番した他の処理とidが重なった場合は、登録の際に IntegrityError となります。
+# (画面の処理では COMPOSITION_ID_CONFLICT_MESSAGE を返して、やり直してもらいます)
+def get_next_composition_id():
+    return max(
+        Composition.objects.aggregate(max_id=Max('id'))['max_id'] or 0,
+        CompositionHistory.objects.aggregate(max_id=Max('composition_original_id'))['max_id'] or 0,
+    ) + 1
 
-    for item in data:
-        all_children.append(item)
-        all_children.extend(get_all_children(item['children']))
 
-    return all_children
+# idを明示して登録したCompositionに合わせて、idのシーケンスを進める。(loaddata と同様)
+def reset_composition_sequence():
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Composition]):
+            cursor.execute(sql)
+
+
+# 採番したidが同時に実行された他の処理と重なった場合のエラーメッセージ
+COMPOSITION_ID_CONFLICT_MESSAGE = "他の変更と同時に実行された為、登録出来ませんでした。もう一度実行して下さい。"
+
+# build_subtree_copy で複製するCompositionの行の項目
+COMPOSITION_COPY_FIELDS = ('id', 'parent_id', 'sort', 'part_id', 'quantity', 'path')
+
+
+def build_subtree_copy(composition, next_id, parent_id, parent_path, sort):
+    """
+    compositionとその配下を複製したCompositionの行を作成する(登録はしません)
+    新しいidは next_id から親より順に採番し、旧id→新idの対応より親id、経路(path)を決めます。
+    件数が多い場合もモデルのインスタンスは作らず、COMPOSITION_COPY_FIELDSの行で返します。
+    :param composition: 複製元のCompositionオブジェクト
+    :param next_id: 採番を始めるid(get_next_composition_id など)
+    :param parent_id: 複製先の親id(製品として複製する場合はNone)
+    :param parent_path: 複製先の親の経路(製品として複製する場合は'/')
+    :param sort: 複製先の並び順
+    :return: COMPOSITION_COPY_FIELDSの行のリスト(先頭がcompositionの複製、親は子より前)
+    """
+    if composition.path is not None:
+        # 経路の順に並べると親は子より前になる。
+        descendants = get_subtree_queryset(composition.path).exclude(pk=composition.id).order_by(
+            'path'
+        ).values_list('id', 'parent_id', 'sort', 'part_id', 'quantity')
+    else:
+        descendants = [(descendant.id, descendant.parent_id, descendant.sort, descendant.part_id, descendant.quantity)
+                       for descendant in get_descendants(composition.id)]
+    new_ids = {composition.id: next_id}
+    paths = {next_id: f'{parent_path}{next_id}/'}
+    rows = [(next_id, parent_id, sort, composition.part_id, composition.quantity, paths[next_id])]
+    for id, old_parent_id, child_sort, part_id, quantity in descendants:
+        next_id += 1
+        new_ids[id] = next_id
+        new_parent_id = new_ids[old_parent_id]
+        paths[next_id] = f'{paths[new_parent_id]}{next_id}/'
+        rows.append((next_id, new_parent_id, child_sort, part_id, quantity, paths[next_id]))
+    return rows
+
+
+# COMPOSITION_COPY_FIELDSの行を、モデルのインスタンスを作らずに QUERY_CHUNK_SIZE 件毎にまとめて登録する。
+def insert_composition_rows(rows):
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(quote_name(Composition._meta.get_field(field).column) for field in COMPOSITION_COPY_FIELDS)
+    sql = (f'INSERT INTO {quote_name(Composition._meta.db_table)} ({columns}) '
+           f'VALUES ({", ".join(["%s"] * len(COMPOSITION_COPY_FIELDS))})')
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+            cursor.executemany(sql, rows[start:start + QUERY_CHUNK_SIZE])
+
+
+# 経路(path)がpathのComposition(自身とその配下)の 'create' の履歴を、1回の INSERT ... SELECT でまとめて記録する。
+def insert_subtree_create_histories(composition_change_set, path):
+    quote_name = connection.ops.quote_name
+    history_columns = ', '.join(quote_name(CompositionHistory._meta.get_field(field).column) for field in (
+        'composition_change_set', 'action', 'status', 'timestamp', 'composition_original_id',
+        'parent_original_id', 'sort', 'part', 'quantity'
+    ))
+    composition_columns = ', '.join(quote_name(Composition._meta.get_field(field).column) for field in (
+        'id', 'parent_id', 'sort', 'part', 'quantity'
+    ))
+    path_column = quote_name(Composition._meta.get_field('path').column)
+    sql = (f'INSERT INTO {quote_name(CompositionHistory._meta.db_table)} ({history_columns}) '
+           f'SELECT %s, %s, %s, %s, {composition_columns} FROM {quote_name(Composition._meta.db_table)} '
+           f'WHERE {path_column} >= %s AND {path_column} < %s ORDER BY {path_column}')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [composition_change_set.id, 'create', 'after',
+                             connection.ops.adapt_datetimefield_value(timezone.now()), path, path[:-1] + '0'])
+
+
+# Compositionの増減より、親部品と子部品の隣接関係(PartAdjacency)の件数を更新する。
+# rows: (親CompositionのID, 子の部品ID, 増減)のリスト
+# part_ids: CompositionのID→部品IDの既知の対応。削除済みの親などはこちらから部品を引きます。
+def update_part_adjacency(rows, part_ids=None):
+    part_ids = dict(part_ids or {})
+    rows = [row for row in rows if row[0] is not None and row[1] is not None]
+    missing_ids = list({parent_id for parent_id, part_id, delta in rows if parent_id not in part_ids})
+    for chunk in chunked(missing_ids):
+        part_ids.update(Composition.objects.filter(id__in=chunk).values_list('id', 'part_id'))
+    deltas = Counter()
+    for parent_id, part_id, delta in rows:
+        if parent_id in part_ids:
+            deltas[(part_ids[parent_id], part_id)] += delta
+    apply_part_adjacency_deltas(deltas)
+
+
+# (親の部品ID, 子の部品ID)毎の件数の増減を、部品の隣接関係(PartAdjacency)へまとめて反映する。
+def apply_part_adjacency_deltas(deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return
+
+    # 対象の隣接関係をまとめて取得し、件数の増減をまとめて反映する。
+    adjacencies = {}
+    parent_part_ids = list({parent_part_id for parent_part_id, child_part_id in deltas})
+    child_part_ids = {child_part_id for parent_part_id, child_part_id in deltas}
+    for chunk in chunked(parent_part_ids):
+        for adjacency in PartAdjacency.objects.filter(parent_part_id__in=chunk):
+            if adjacency.child_part_id in child_part_ids:
+                adjacencies[(adjacency.parent_part_id, adjacency.child_part_id)] = adjacency
+    new_adjacencies = []
+    changed_adjacencies = []
+    deleted_ids = []
+    for (parent_part_id, child_part_id), delta in deltas.items():
+        adjacency = adjacencies.get((parent_part_id, child_part_id))
+        if adjacency is None:
+            if delta > 0:
+                new_adjacencies.append(PartAdjacency(parent_part_id=parent_part_id,
+                                                     child_part_id=child_part_id, count=delta))
+            continue
+        adjacency.count += delta
+        if adjacency.count > 0:
+            changed_adjacencies.append(adjacency)
+        else:
+            deleted_ids.append(adjacency.id)
+    PartAdjacency.objects.bulk_create(new_adjacencies, batch_size=QUERY_CHUNK_SIZE)
+    PartAdjacency.objects.bulk_update(changed_adjacencies, ['count'], batch_size=QUERY_CHUNK_SIZE)
+    for chunk in chunked(deleted_ids):
+        PartAdjacency.objects.filter(id__in=chunk).delete()
+
+
+# CompositionHistoryの内容より部品の隣接関係を更新する。
+# sign=1で履歴の通りに反映(やり直し)、sign=-1で履歴を打ち消す方向(元に戻す)に反映します。
+def update_part_adjacency_from_histories(histories, sign=1):
+    signs = {
+        ('create', 'after'): 1,
+        ('update', 'before'): -1,
+        ('update', 'after'): 1,
+        ('delete', 'before'): -1,
+    }
+    rows = []
+    part_ids = {}
+    for history in histories:
+        if (history.action, history.status) not in signs:
+            continue
+        part_ids[history.composition_original_id] = history.part_id
+        rows.append((history.parent_original_id, history.part_id,
+                     signs[(history.action, history.status)] * sign))
+    update_part_adjacency(rows, part_ids)
+
+
+# 経路(path)が前方一致するComposition(自身とその配下)のクエリセットを返す。
+# 経路はidと'/'のみなので、'/'の次の文字('0')で範囲の上限を決め、インデックスの範囲検索にします。
+def get_subtree_queryset(path):
+    return Composition.objects.filter(path__gte=path, path__lt=path[:-1] + '0')
+
+
+# 経路(path)より、製品から自身までのidのリストを返す。
+def get_path_ids(path):
+    return [int(id) for id in path.strip('/').split('/')]
+
+
+# CompositionHistoryの内容より、経路(path)を更新するCompositionのidを求めて経路を更新する。
+# 作成、削除を打ち消して作り直したもの、親が変わったものが対象です。
+# (親の変わらない更新、並び順シフトは経路に影響しません)
+def update_composition_paths_from_histories(histories):
+    ids = set()
+    parent_ids = {}
+    for history in histories:
+        if history.action in ('create', 'delete'):
+            ids.add(history.composition_original_id)
+        elif history.action == 'update':
+            parent_ids.setdefault(history.composition_original_id, set()).add(history.parent_original_id)
+    ids.update(id for id, parents in parent_ids.items() if len(parents) > 1)
+    update_composition_paths(ids)
+
+
+def update_composition_paths(ids):
+    """
+    指定したCompositionの経路(path)を、親の経路より設定し直す。
+    既に経路があり変わった場合は、配下の経路の前方を経路の範囲検索でまとめて書き換えます。
+    指定したComposition同士が親子の場合(削除を打ち消して作り直した配下など)は、親から順に求めます。
+    :param ids: 作成、または親を変更したCompositionのidの集合
+    """
+    rows = {}
+    for chunk in chunked(list(ids)):
+        for id, parent_id, path in Composition.objects.filter(id__in=chunk).values_list('id', 'parent_id', 'path'):
+            rows[id] = (parent_id, path)
+    parent_paths = {}
+    outer_parent_ids = {parent_id for parent_id, path in rows.values() if parent_id is not None} - rows.keys()
+    for chunk in chunked(list(outer_parent_ids)):
+        parent_paths.update(Composition.objects.filter(id__in=chunk).values_list('id', 'path'))
+
+    new_paths = {}
+    resolving_ids = set()
+
+    # idの新しい経路を、指定したComposition内は親から順に求める。(親子関係が循環している場合はNone)
+    def resolve(id):
+        chain = []
+        while id in rows and id not in new_paths and id not in resolving_ids:
+            chain.append(id)
+            resolving_ids.add(id)
+            id = rows[id][0]
+        if id in resolving_ids:
+            path = None
+        elif id is None:
+            path = '/'
+        elif id in new_paths:
+            path = new_paths[id]
+        else:
+            path = resolve_outer(id)
+        for id in reversed(chain):
+            path = None if path is None else f'{path}{id}/'
+            new_paths[id] = path
+        resolving_ids.difference_update(chain)
+        return path
+
+    # 指定したComposition外の親の経路を求める。
+    # 経路上に指定したCompositionがある場合は、書き換え前の経路なので、その新しい経路に付け替えます。
+    def resolve_outer(id):
+        path = parent_paths.get(id)
+        if path is None:
+            return None
+        path_ids = get_path_ids(path)
+        for index in range(len(path_ids) - 2, -1, -1):
+            if path_ids[index] in rows:
+                base_path = resolve(path_ids[index])
+                if base_path is None:
+                    return None
+                return base_path + ''.join(f'{path_id}/' for path_id in path_ids[index + 1:])
+        return path
+
+    for id in rows:
+        resolve(id)
+
+    changed_ids = [id for id, path in new_paths.items() if path is not None and path != rows[id][1]]
+    # 経路の変わったCompositionの配下を、浅い階層から順に書き換える。
+    # 先に書き換えた範囲に含まれる場合は、書き換え後の経路を元に範囲を決めます。
+    rewrites = []
+    for id in sorted(changed_ids, key=lambda id: new_paths[id].count('/')):
+        old_path = rows[id][1]
+        if old_path is None:
+            continue
+        for old_prefix, new_prefix in rewrites:
+            if old_path.startswith(old_prefix):
+                old_path = new_prefix + old_path[len(old_prefix):]
+        if old_path == new_paths[id]:
+            continue
+        get_subtree_queryset(old_path).update(
+            path=Concat(Value(new_paths[id]), Substr('path', len(old_path) + 1))
+        )
+        rewrites.append((old_path, new_paths[id]))
+    Composition.objects.bulk_update(
+        [Composition(id=id, path=new_paths[id]) for id in changed_ids], ['path'], batch_size=QUERY_CHUNK_SIZE
+    )
+
+
+# 全ての(または指定した製品の)Compositionの経路(path)を、製品から階層毎に作り直す。
+# 作り直したCompositionの件数を返します。(build_composition_paths コマンドより呼び出します)
+def rebuild_composition_paths(product_ids=None):
+    products = Composition.objects.filter(parent_id__isnull=True)
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+    paths = {id: f'/{id}/' for id in products.values_list('id', flat=True)}
+    count = 0
+    while paths:
+        Composition.objects.bulk_update(
+            [Composition(id=id, path=path) for id, path in paths.items()], ['path'], batch_size=QUERY_CHUNK_SIZE
+        )
+        count += len(paths)
+        next_paths = {}
+        for chunk in chunked(list(paths)):
+            for id, parent_id in Composition.objects.filter(parent_id__in=chunk).values_list('id', 'parent_id'):
+                if id not in next_paths and str(id) not in paths[parent_id].split('/'):
+                    next_paths[id] = f'{paths[parent_id]}{id}/'
+        paths = next_paths
+    return count
+
+
+# PartAdjacencyを階層毎に辿り、指定した部品の配下で直接、間接に使用されている部品のIDのセットを返す。
+# stop_part_ids の部品に辿り着いた場合は、その時点で辿るのを止めます。
+def get_contained_part_ids(part_ids, stop_part_ids=()):
+    contained_part_ids = set()
+    frontier = list(part_ids)
+    while frontier:
+        next_frontier = []
+        for chunk in chunked(frontier):
+            for reached_part_id in PartAdjacency.objects.filter(
+                parent_part_id__in=chunk
+            ).values_list('child_part_id', flat=True):
+                if reached_part_id not in contained_part_ids:
+                    contained_part_ids.add(reached_part_id)
+                    next_frontier.append(reached_part_id)
+        if not contained_part_ids.isdisjoint(stop_part_ids):
+            break
+        frontier = next_frontier
+    return contained_part_ids
+
+
+# 指定したproductのUndoRedoPointerを追加したcomposition_change_setへ更新し、UndoRedoPointerを返す。
+# 既に取得済みのUndoRedoPointerがあれば undo_redo_pointer に渡します。
+# composition_change_setで製品自体を作成した場合は product_created に True を渡します。
+def set_undo_redo_pointer(product, composition_change_set, undo_redo_pointer=None, product_created=False):
+    creation_change_set_id = composition_change_set.id if product_created else None
+    if undo_redo_pointer is None:
+        # 指定したproductのUndoRedoPointerオブジェクトを取得
+        undo_redo_pointer, created = UndoRedoPointer.objects.get_or_create(
+            product=product,
+            defaults={
+                'pointer': composition_change_set,
+                'first_change_set_id': composition_change_set.id,
+                'last_change_set_id': composition_change_set.id,
+                'creation_change_set_id': creation_change_set_id
+            }
+        )
+        if created:
+            return undo_redo_pointer
+    # すでに存在する場合は、pointer_idと最初、最後の構成変更セットのidを更新
+    undo_redo_pointer.pointer = composition_change_set
+    undo_redo_pointer.last_change_set_id = composition_change_set.id
+    if undo_redo_pointer.first_change_set_id is None:
+        undo_redo_pointer.first_change_set_id = composition_change_set.id
+    if creation_change_set_id is not None:
+        undo_redo_pointer.creation_change_set_id = creation_change_set_id
+    undo_redo_pointer.save(update_fields=['pointer', 'first_change_set_id', 'last_change_set_id',
+                                          'creation_change_set_id'])
+    return undo_redo_pointer
+
+
+class CompositionChangeRecorder:
+    """
+    CompositionChangeRecorder は、1つの CompositionChangeSet に属する Composition の
+    更新前後のスナップショットをメモリ上に集め、flush() にてまとめて書き込みます。
+
+    各変更画面の処理はこのクラスを通して Composition を更新します。
+    - create: Composition を登録し、'create' の履歴を記録します。
+    - create_subtree: 複製した Composition の部分木をまとめて登録し、'create' の履歴を経路の範囲でまとめて記録します。
+      (登録済みの部分木は record_subtree で記録のみ行います)
+    - update: Composition の値を変更し、'update' の前後の履歴を記録します。
+      更新自体は flush() の際に bulk_update で反映します。
+    - delete_subtree: Composition とその配下を削除し、'delete' の履歴を記録します。
+    - shift_siblings: 兄弟の並び順を1回のUPDATEでまとめてずらし、'shift' の履歴を1件だけ記録します。
+    - flush: 保留中の更新を bulk_update、履歴を bulk_create で書き込み、UndoRedoPointer を更新します。
+    - undo_redo_status: flush 後の「元に戻す」、「やり直し」が出来るかを、クエリを発行せずに返します。
+    """
+    def __init__(self, product, undo_redo_pointer=None):
+        self.product = product
+        self.undo_redo_pointer = undo_redo_pointer
+        self.composition_change_set = CompositionChangeSet.objects.create(product=product)
+        self.histories = []
+        self.pending_updates = {}
+        self.created_subtree_paths = []
+
+    @classmethod
+    def start(cls, product_id):
+        # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新してから
+        # 新しい CompositionChangeSet インスタンスを作成する。
+        undo_redo_pointer = update_history_from_pointer(product_id)
+        return cls(Composition.objects.get(id=product_id), undo_redo_pointer)
+
+    def snapshot(self, composition, action, status):
+        self.histories.append(CompositionHistory(
+            composition_change_set=self.composition_change_set,
+            composition_original_id=composition.id,
+            parent_original_id=composition.parent_id,
+            sort=composition.sort,
+            part_id=composition.part_id,
+            quantity=composition.quantity,
+            action=action,
+            status=status
+        ))
+
+    def create(self, composition):
+        composition.save()
+        self.snapshot(composition, 'create', 'after')
+        return composition
+
+    def update(self, composition, **values):
+        self.snapshot(composition, 'update', 'before')
+        for field, value in values.items():
+            setattr(composition, field, value)
+        self.snapshot(composition, 'update', 'after')
+        self.pending_updates[composition.id] = composition
+        return composition
+
+    def create_subtree(self, rows):
+        """
+        build_subtree_copy で複製した行をまとめて登録する
+        件数が多い為、履歴はモデルのインスタンスを作らず、flush() の際に経路の範囲よりまとめて記録します。
+        部品の隣接関係もここで行より更新します。
+        :param rows: COMPOSITION_COPY_FIELDSの行のリスト(先頭が複製した部分木の頂点)
+        """
+        insert_composition_rows(rows)
+        reset_composition_sequence()
+        self.record_subtree(rows)
+
+    def record_subtree(self, rows):
+        """
+        登録済みの部分木の行を、作成した部分木として記録する
+        :param rows: COMPOSITION_COPY_FIELDSの行のリスト(先頭が部分木の頂点)
+        """
+        part_ids = {id: part_id for id, parent_id, sort, part_id, quantity, path in rows}
+        update_part_adjacency([(parent_id, part_id, 1) for id, parent_id, sort, part_id, quantity, path in rows],
+                              part_ids)
+        self.created_subtree_paths.append(rows[0][5])
+
+    def delete_subtree(self, composition):
+        delete_subtree(composition, self)
+
+    def shift_siblings(self, parent_id, from_sort, count=1):
+        """
+        parent_id配下でfrom_sort以降の並び順の兄弟をcount分後ろへずらし、
+        from_sortからcount件分の並び順を空ける。
+        既に空いている場合(並び順に隙間がある場合)はずらしません。
+        製品(parent_id が None)の兄弟は無いので、製品の前後を指定した場合はエラーとします。
+        :return: ずらした場合はTrue、それ以外はFalse
+        """
+        if parent_id is None:
+            raise ValueError("製品の前後には挿入、移動できません。")
+        # 保留中の更新はずらす前の並び順として反映しておく必要がある為、先に反映する。
+        self.update_pending()
+        if not Composition.objects.filter(
+            parent_id=parent_id,
+            sort__gte=from_sort,
+            sort__lt=from_sort + count
+        ).exists():
+            return False
+        Composition.objects.filter(
+            parent_id=parent_id,
+            sort__gte=from_sort
+        ).update(sort=F('sort') + count)
+        self.histories.append(CompositionHistory(
+            composition_change_set=self.composition_change_set,
+            composition_original_id=parent_id,
+            parent_original_id=parent_id,
+            sort=from_sort,
+            quantity=count,
+            action='shift',
+            status='after'
+        ))
+        return True
+
+    def update_pending(self):
+        if self.pending_updates:
+            Composition.objects.bulk_update(
+                list(self.pending_updates.values()),
+                ['parent_id', 'sort', 'part', 'quantity'],
+                batch_size=QUERY_CHUNK_SIZE
+            )
+            self.pending_updates = {}
+
+    def flush(self):
+        self.update_pending()
+        update_part_adjacency_from_histories(self.histories)
+        update_composition_paths_from_histories(self.histories)
+        # 製品自体を複製した場合は、製品の経路の部分木を作成している。
+        product_created = is_product_created(self.histories, self.product.id) or \
+            f'/{self.product.id}/' in self.created_subtree_paths
+        histories = CompositionHistory.objects.bulk_create(self.histories, batch_size=QUERY_CHUNK_SIZE)
+        self.histories = []
+        for path in self.created_subtree_paths:
+            insert_subtree_create_histories(self.composition_change_set, path)
+        self.created_subtree_paths = []
+        self.undo_redo_pointer = set_undo_redo_pointer(self.product, self.composition_change_set,
+                                                       self.undo_redo_pointer, product_created)
+        invalidate_tree_cache(self.product.id)
+        # 設定されていれば、変更の確定後に古い構成履歴を圧縮する。
+        if getattr(settings, 'PART_LIST_COMPACT_HISTORY_ON_COMMIT', False):
+            product_id = self.product.id
+            transaction.on_commit(lambda: compact_history(product_id))
+        return histories
+
+    def undo_redo_status(self):
+        return get_undo_redo_status(self.undo_redo_pointer)
 
 
 # TODO 追加画面の製品挿入処理
@@ -189,15 +789,14 @@ def composition_add_product(request):
     edit_block_code = request.GET.get("edit_block_code")
     try:
         # エラーチェック
-        if not Part.objects.filter(code=edit_block_code).exists():
+        part_instance = get_part_by_code(edit_block_code)
+        if part_instance is None:
             raise ValueError("存在しない製品が指定されました。")
 
         # 実行
         with transaction.atomic():
             # 製品の登録
             # new_composition_instance = Composition()
-            # edit_block_code を適切な PartMaster インスタンスに変更する
-            part_instance = Part.objects.get(code=edit_block_code)
             new_composition_instance = Composition()
             new_composition_instance.parent_id = None
             new_composition_instance.sort = 1
@@ -205,29 +804,9 @@ def composition_add_product(request):
             new_composition_instance.quantity = None
             new_composition_instance.save()
 
-            composition_change_set = CompositionChangeSet.objects.create(product=new_composition_instance)
-
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=new_composition_instance.id,
-                parent_original_id=new_composition_instance.parent_id,
-                sort=new_composition_instance.sort,
-                part=new_composition_instance.part,
-                quantity=new_composition_instance.quantity,
-                action='create',
-                status='after'
-            )
-            # 指定したproductのUndoRedoPointerオブジェクトを取得
-            pointer, created = UndoRedoPointer.objects.get_or_create(
-                product=new_composition_instance,
-                defaults={
-                    'pointer': composition_change_set
-                }
-            )
-            # すでに存在する場合は、pointer_idを更新
-            if not created:
-                pointer.pointer = composition_change_set
-                pointer.save()
+            recorder = CompositionChangeRecorder(new_composition_instance)
+            recorder.snapshot(new_composition_instance, 'create', 'after')
+            recorder.flush()
     except ValueError as e:
         # ここではエラーがキャッチされますが、
         # withブロック内で例外が発生した場合、
@@ -235,13 +814,51 @@ def composition_add_product(request):
         # print(f"トランザクションがロールバックされました: {e}")
         # return JsonResponse({"exists": False})
         return JsonResponse({"success": False, "message": str(e)})
-    undo_status, redo_status = check_undo_redo(new_composition_instance.id)
+    undo_status, redo_status = recorder.undo_redo_status()
     return JsonResponse({"success": True,
                          "new_id": new_composition_instance.id,
                          "name": part_instance.name, 'undo': undo_status,
                          "redo": redo_status})
 
 
+# 一覧画面、変更画面の製品の複製処理
+# 製品の構成全体を、edit_block_code の部品を製品とした新しい製品へまとめて複製します。
+def composition_edit_clone(request, product_id):
+    edit_block_code = request.GET.get("edit_block_code")
+    try:
+        # エラーチェック
+        part_instance = get_part_by_code(edit_block_code)
+        if part_instance is None:
+            raise ValueError("存在しない製品が指定されました。")
+
+        # 実行
+        with transaction.atomic():
+            product = Composition.objects.get(pk=product_id, parent_id__isnull=True)
+            rows = build_subtree_copy(product, get_next_composition_id(), None, '/', 1)
+            # 複製元には循環参照が無い為、新しい製品の部品が配下に無ければ循環参照は発生しません。
+            if any(row[3] == part_instance.id for row in rows[1:]):
+                raise ValueError("循環参照エラーが発生致しました。")
+            new_id, parent_id, sort, part_id, quantity, path = rows[0]
+            rows[0] = (new_id, parent_id, sort, part_instance.id, quantity, path)
+
+            # 構成変更セットは製品を参照するので、複製した製品を登録してから記録を開始する。
+            insert_composition_rows(rows)
+            reset_composition_sequence()
+            recorder = CompositionChangeRecorder(Composition.objects.get(pk=new_id))
+            recorder.record_subtree(rows)
+            recorder.flush()
+    except ValueError as e:
+        return JsonResponse({"success": False, "message": str(e)})
+    except IntegrityError:
+        # 採番したidが同時に複製、複写した他の処理と重なった。(トランザクションはロールバック済み)
+        return JsonResponse({"success": False, "message": COMPOSITION_ID_CONFLICT_MESSAGE})
+    undo_status, redo_status = recorder.undo_redo_status()
+    return JsonResponse({"success": True,
+                         "new_id": new_id,
+                         "name": part_instance.name, "undo": undo_status,
+                         "redo": redo_status})
+
+
 # 変更画面の挿入処理
 def composition_edit_add(request, product_id):
     current_composition_id = request.GET.get("current_composition_id")
@@ -249,91 +866,41 @@ def composition_edit_add(request, product_id):
     edit_block_quantity = request.GET.get("edit_block_quantity")
     try:
         # エラーチェック
-        if not Part.objects.filter(code=edit_block_code).exists():
+        part_instance = get_part_by_code(edit_block_code)
+        if part_instance is None:
             raise ValueError("存在しない部品が指定されました。")
             # return JsonResponse({"exists": False})
 
         # 実行
         with transaction.atomic():
-            # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新する。
-            update_history_from_pointer(product_id)
-
-            composition = Composition.objects.get(id=product_id)
-            composition_change_set = CompositionChangeSet.objects.create(
-                product=composition
-            )
+            # 新しい CompositionChangeSet の記録を開始
+            recorder = CompositionChangeRecorder.start(product_id)
 
             current_composition = Composition.objects.get(
                 pk=current_composition_id
             )
+            if current_composition.parent_id is None:
+                raise ValueError("製品の前には挿入できません。")
             new_composition_sort = current_composition.sort
             # current_composition.parent_idと同じ値かつ
-            # current_composition.part以上の値のインスタンスを取得
-            change_sort_instances = Composition.objects.filter(
-                parent_id=current_composition.parent_id,
-                sort__gte=current_composition.sort
-            )
-            # 取得したインスタンスの part_sort を更新して保存
-            for instance in change_sort_instances:
-                CompositionHistory.objects.create(
-                    composition_change_set=composition_change_set,
-                    composition_original_id=instance.id,
-                    parent_original_id=instance.parent_id,
-                    sort=instance.sort,
-                    part=instance.part,
-                    quantity=instance.quantity,
-                    action='update',
-                    status='before'
-                )
-                instance.sort += 1
-                instance.save()
-                CompositionHistory.objects.create(
-                    composition_change_set=composition_change_set,
-                    composition_original_id=instance.id,
-                    parent_original_id=instance.parent_id,
-                    sort=instance.sort,
-                    part=instance.part,
-                    quantity=instance.quantity,
-                    action='update',
-                    status='after'
-                )
+            # current_composition.sort以上の値のインスタンスの sort をまとめて1つ後ろへずらす
+            recorder.shift_siblings(current_composition.parent_id, new_composition_sort)
 
             # new_composition_instance = Composition()
-            # edit_block_code を適切な PartMaster インスタンスに変更する
-            part_instance = Part.objects.get(code=edit_block_code)
             new_composition_instance = Composition()
             # 正しい Part インスタンスを設定
             new_composition_instance.part = part_instance
             new_composition_instance.sort = new_composition_sort
             new_composition_instance.quantity = edit_block_quantity
             new_composition_instance.parent_id = current_composition.parent_id
-            new_composition_instance.save()
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=new_composition_instance.id,
-                parent_original_id=new_composition_instance.parent_id,
-                sort=new_composition_instance.sort,
-                part=new_composition_instance.part,
-                quantity=new_composition_instance.quantity,
-                action='create',
-                status='after'
-            )
-            # 指定したproductのUndoRedoPointerオブジェクトを取得
-            pointer, created = UndoRedoPointer.objects.get_or_create(
-                product=composition,
-                defaults={
-                    'pointer': composition_change_set
-                }
-            )
-            # すでに存在する場合は、pointer_idを更新
-            if not created:
-                pointer.pointer = composition_change_set
-                pointer.save()
+            recorder.create(new_composition_instance)
+            histories = recorder.flush()
 
             # 更新された値よりcompositionに循環参照が発生しているか
             # 確認し発生していたら、ロールバックしてエラーメッセージを戻す。
-            if check_for_cyclic_parts(product_id):
+            if check_for_cyclic_composition(new_composition_instance):
                 raise ValueError("循環参照エラーが発生致しました。")
+            diff = get_tree_diff(histories)
 
     except ValueError as e:
         # ここではエラーがキャッチされますが、
@@ -342,11 +909,11 @@ def composition_edit_add(request, product_id):
         # print(f"トランザクションがロールバックされました: {e}")
         # return JsonResponse({"exists": False})
         return JsonResponse({"success": False, "message": str(e)})
-    undo_status, redo_status = check_undo_redo(product_id)
+    undo_status, redo_status = recorder.undo_redo_status()
     return JsonResponse({"success": True,
                          "new_id": new_composition_instance.id,
                          "name": part_instance.name, "undo": undo_status,
-                         "redo": redo_status})
+                         "redo": redo_status, "diff": diff})
 
 
 # 変更画面の子の挿入処理
@@ -358,17 +925,13 @@ def composition_edit_add_children(request, product_id):
         # エラーチェック
         #  if Part.objects.filter(code=edit_block_code).exists():
         #     exists = True
-        if not Part.objects.filter(code=edit_block_code).exists():
+        part_instance = get_part_by_code(edit_block_code)
+        if part_instance is None:
             raise ValueError("存在しない部品が指定されました。")
         # 実行
         with transaction.atomic():
-            # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新する。
-            update_history_from_pointer(product_id)
-            # 新しい CompositionChangeSet インスタンスを作成
-            composition = Composition.objects.get(id=product_id)
-            composition_change_set = CompositionChangeSet.objects.create(
-                product=composition
-            )
+            # 新しい CompositionChangeSet の記録を開始
+            recorder = CompositionChangeRecorder.start(product_id)
             current_composition = Composition.objects.get(
                 pk=current_composition_id
             )
@@ -382,8 +945,6 @@ def composition_edit_add_children(request, product_id):
             else:
                 new_composition_sort = 1
 
-            # edit_block_code を適切な Part インスタンスに変更する
-            part_instance = Part.objects.get(code=edit_block_code)
             new_composition_instance = Composition()
             # 正しい Part インスタンスを設定
             new_composition_instance.part = part_instance
@@ -394,35 +955,14 @@ def composition_edit_add_children(request, product_id):
             # parent_instance = Part.objects.get(code=current_composition)
             new_composition_instance.parent_id = current_composition.id
             # new_composition_instance.parent = parent_instance
-            new_composition_instance.save()
-            # aaa = CompositionHistory.objects.create(
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=new_composition_instance.id,
-                parent_original_id=new_composition_instance.parent_id,
-                sort=new_composition_instance.sort,
-                part=new_composition_instance.part,
-                quantity=new_composition_instance.quantity,
-                action='create',
-                status='after'
-
-            )
-            # 指定したproductのUndoRedoPointerオブジェクトを取得
-            pointer, created = UndoRedoPointer.objects.get_or_create(
-                product=composition,
-                defaults={
-                    'pointer': composition_change_set
-                }
-            )
-            # すでに存在する場合は、pointer_idを更新
-            if not created:
-                pointer.pointer = composition_change_set
-                pointer.save()
+            recorder.create(new_composition_instance)
+            histories = recorder.flush()
 
             # 更新された値よりcompositionに循環参照が発生しているか
             # 確認し発生していたら、ロールバックしてエラーメッセージを戻す。
-            if check_for_cyclic_parts(product_id):
+            if check_for_cyclic_composition(new_composition_instance):
                 raise ValueError("循環参照エラーが発生致しました。")
+            diff = get_tree_diff(histories)
 
     except ValueError as e:
         # ここではエラーがキャッチされますが、
@@ -432,12 +972,13 @@ def composition_edit_add_children(request, product_id):
         # return JsonResponse({"exists": False})
         return JsonResponse({"success": False, "message": str(e)})
 
-    undo_status, redo_status = check_undo_redo(product_id)
+    undo_status, redo_status = recorder.undo_redo_status()
     return JsonResponse({"success": True,
                          "new_id": new_composition_instance.id,
                          "name": part_instance.name,
                          "undo": undo_status,
-                         "redo": redo_status
+                         "redo": redo_status,
+                         "diff": diff
                          })
 
 
@@ -447,53 +988,21 @@ def composition_edit_mod(request, product_id):
     edit_block_code = request.GET.get("edit_block_code")
     edit_block_quantity = request.GET.get("edit_block_quantity")
     # エラーチェック
-    if Part.objects.filter(code=edit_block_code).exists():
+    if get_part_by_code(edit_block_code) is not None:
         exists = True
         # 実行
         with transaction.atomic():
-            # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新する。
-            update_history_from_pointer(product_id)
-            # 新しい CompositionChangeSet インスタンスを作成
-            composition = Composition.objects.get(id=product_id)
-            composition_change_set = CompositionChangeSet.objects.create(product=composition)
+            # 新しい CompositionChangeSet の記録を開始
+            recorder = CompositionChangeRecorder.start(product_id)
             current_composition = Composition.objects.get(pk=current_composition_id)
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=current_composition.id,
-                parent_original_id=current_composition.parent_id,
-                sort=current_composition.sort,
-                part=current_composition.part,
-                quantity=current_composition.quantity,
-                action='update',
-                status='before'
-            )
-            current_composition.quantity = edit_block_quantity
-            current_composition.save()
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=current_composition.id,
-                parent_original_id=current_composition.parent_id,
-                sort=current_composition.sort,
-                part=current_composition.part,
-                quantity=current_composition.quantity,
-                action='update',
-                status='after'
-            )
-            # 指定したproductのUndoRedoPointerオブジェクトを取得
-            pointer, created = UndoRedoPointer.objects.get_or_create(
-                product=composition,
-                defaults={
-                    'pointer': composition_change_set
-                }
-            )
-            # すでに存在する場合は、pointer_idを更新
-            if not created:
-                pointer.pointer = composition_change_set
-                pointer.save()
+            recorder.update(current_composition, quantity=edit_block_quantity)
+            diff = get_tree_diff(recorder.flush())
+            undo_status, redo_status = recorder.undo_redo_status()
     else:
         exists = False
-    undo_status, redo_status = check_undo_redo(product_id)
-    return JsonResponse({"exists": exists, 'undo': undo_status, 'redo': redo_status})
+        diff = None
+        undo_status, redo_status = check_undo_redo(product_id)
+    return JsonResponse({"exists": exists, 'undo': undo_status, 'redo': redo_status, 'diff': diff})
 
 
 # 変更画面のドロップイベント
@@ -501,10 +1010,8 @@ def composition_edit_drop(request, product_id):
     try:
         # 実行
         with transaction.atomic():
-            update_history_from_pointer(product_id)
-            # 新しい CompositionChangeSet インスタンスを作成
-            composition = Composition.objects.get(id=product_id)
-            composition_change_set = CompositionChangeSet.objects.create(product=composition)
+            # 新しい CompositionChangeSet の記録を開始
+            recorder = CompositionChangeRecorder.start(product_id)
             drop_target_id = request.GET.get("drop_target_id")    # 移動先のid
             insert_position = request.GET.get("insert_position")    # 移動先のidの前"before"、後"after"の情報
             dragged_id = request.GET.get("dragged_id")          # ドラッグした要素のid
@@ -513,75 +1020,22 @@ def composition_edit_drop(request, product_id):
             print('dragged_id:', dragged_id)
             # ドロップ先のインスタンスを取得
             drop_target_composition = Composition.objects.get(pk=drop_target_id)
-            change_compositions = change_sorts(drop_target_composition, insert_position, dragged_id)
-
-            # ドロップ先の後ろのソートを書き換える
-            for change_composition in change_compositions:
-                CompositionHistory.objects.create(
-                    composition_change_set=composition_change_set,
-                    composition_original_id=change_composition.id,
-                    parent_original_id=change_composition.parent_id,
-                    sort=change_composition.sort,
-                    part=change_composition.part,
-                    quantity=change_composition.quantity,
-                    action='update',
-                    status='before'
-                )
-                change_composition.sort += 1
-                change_composition.save()
-                CompositionHistory.objects.create(
-                    composition_change_set=composition_change_set,
-                    composition_original_id=change_composition.id,
-                    parent_original_id=change_composition.parent_id,
-                    sort=change_composition.sort,
-                    part=change_composition.part,
-                    quantity=change_composition.quantity,
-                    action='update',
-                    status='after'
-                )
-            # 移動元のparent,sortを書き換える
             dragged_composition = Composition.objects.get(pk=dragged_id)
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=dragged_composition.id,
-                parent_original_id=dragged_composition.parent_id,
-                sort=dragged_composition.sort,
-                part=dragged_composition.part,
-                quantity=dragged_composition.quantity,
-                action='update',
-                status='before'
-            )
-            dragged_composition.parent_id = drop_target_composition.parent_id
+            # 製品の前後への移動や、製品自体の移動は出来ない。
+            if drop_target_composition.parent_id is None or dragged_composition.parent_id is None:
+                raise ValueError("製品の前後には移動できません。")
             if insert_position == 'before':
-                dragged_composition.sort = drop_target_composition.sort
+                new_sort = drop_target_composition.sort
             else:
-                dragged_composition.sort = drop_target_composition.sort + 1
-            dragged_composition.save()
-            CompositionHistory.objects.create(
-                composition_change_set=composition_change_set,
-                composition_original_id=dragged_composition.id,
-                parent_original_id=dragged_composition.parent_id,
-                sort=dragged_composition.sort,
-                part=dragged_composition.part,
-                quantity=dragged_composition.quantity,
-                action='update',
-                status='after'
-            )
-            # 指定したproductのUndoRedoPointerオブジェクトを取得
-            pointer, created = UndoRedoPointer.objects.get_or_create(
-                product=composition,
-                defaults={
-                    'pointer': composition_change_set
-                }
-            )
-            # すでに存在する場合は、pointer_idを更新
-            if not created:
-                pointer.pointer = composition_change_set
-                pointer.save()
+                new_sort = drop_target_composition.sort + 1
+            move_compositions(recorder, [dragged_composition],
+                              drop_target_composition.parent_id, new_sort)
+            histories = recorder.flush()
             # 更新された値よりcompositionに循環参照が発生しているか
             # 確認し発生していたら、ロールバックしてエラーメッセージを戻す。
-            if check_for_cyclic_parts(product_id):
+            if check_for_cyclic_composition(dragged_composition):
                 raise ValueError("循環参照エラーが発生致しました。")
+            diff = get_tree_diff(histories)
     except ValueError as e:
         # ここではエラーがキャッチされますが、
         # withブロック内で例外が発生した場合、
@@ -589,73 +1043,169 @@ def composition_edit_drop(request, product_id):
         # print(f"トランザクションがロールバックされました: {e}")
         return JsonResponse({"success": False, "message": str(e)})
 
-    undo_status, redo_status = check_undo_redo(product_id)
+    undo_status, redo_status = recorder.undo_redo_status()
     # return JsonResponse({"exists": exists, 'undo': undo_status, 'redo': redo_status})
     return JsonResponse({"success": True,
                          "undo": undo_status,
-                         "redo": redo_status})
+                         "redo": redo_status,
+                         "diff": diff})
+
+
+# compositionsを親parent_idの並び順new_sortの位置へ、指定された順に並べて移動する。
+# 移動する要素を一旦並び順0(兄弟の並び順は1以上)へ退避させてから兄弟の並び順をまとめてずらすので、
+# 'shift' の履歴を元に戻す/やり直す際も移動する要素が並び順をずらす対象に含まれません。
+def move_compositions(recorder, compositions, parent_id, new_sort):
+    for composition in compositions:
+        recorder.update(composition, parent_id=parent_id, sort=0)
+    recorder.shift_siblings(parent_id, new_sort, len(compositions))
+    for i, composition in enumerate(compositions):
+        recorder.update(composition, sort=new_sort + i)
+
+
+# 変更画面の複数選択した構成の移動処理
+def composition_edit_move(request, product_id):
+    return paste_compositions(request, product_id, copy=False)
+
 
+# 変更画面の複数選択した構成の複写処理
+def composition_edit_copy(request, product_id):
+    return paste_compositions(request, product_id, copy=True)
 
-# ソート変更対象のidを格納する。
-def change_sorts(drop_target_composition, insert_position, dragged_id):
+
+def paste_compositions(request, product_id, copy):
+    """
+    source_ids(カンマ区切り)の構成を、target_id の前"before"、後"after"、子"children"(末尾)へまとめて移動、複写する
+    全ての移動、複写を1つのトランザクション、1つの CompositionChangeSet で行い、
+    部品の循環参照のチェックも最後に1回だけ行います。
+    :param request: source_ids、target_id、insert_position を持つリクエスト
+    :param product_id: 製品のCompositionのID
+    :param copy: Trueの場合は複写、Falseの場合は移動
+    :return: JsonResponse(success、undo、redo、diff、エラーの場合は message)
+    """
+    try:
+        # 実行
+        with transaction.atomic():
+            # 新しい CompositionChangeSet の記録を開始
+            recorder = CompositionChangeRecorder.start(product_id)
+            sources = get_paste_sources(request.GET.get("source_ids", ""), product_id)
+            target = Composition.objects.filter(pk=request.GET.get("target_id")).first()
+            if target is None or target.path is None or not target.path.startswith(f'/{product_id}/'):
+                raise ValueError("移動先の構成が不正です。")
+            parent_id, new_sort = get_paste_position(target, request.GET.get("insert_position"))
+            if copy:
+                compositions = copy_compositions(recorder, sources, parent_id, new_sort)
+            else:
+                move_compositions(recorder, sources, parent_id, new_sort)
+                compositions = sources
+            histories = recorder.flush()
+            # 更新された値よりcompositionに循環参照が発生しているか
+            # 確認し発生していたら、ロールバックしてエラーメッセージを戻す。
+            if check_for_cyclic_compositions(compositions):
+                raise ValueError("循環参照エラーが発生致しました。")
+            if copy:
+                # 複写した配下の履歴はまとめて登録しているので、複写した頂点のみ差分へ含める。
+                # (配下は展開した時に読み込みます)
+                histories = histories + [
+                    CompositionHistory(composition_original_id=composition.id, parent_original_id=parent_id,
+                                       action='create', status='after')
+                    for composition in compositions
+                ]
+            diff = get_tree_diff(histories)
+    except ValueError as e:
+        return JsonResponse({"success": False, "message": str(e)})
+    except IntegrityError:
+        # 複写で採番したidが同時に複製、複写した他の処理と重なった。(トランザクションはロールバック済み)
+        return JsonResponse({"success": False, "message": COMPOSITION_ID_CONFLICT_MESSAGE})
+
+    undo_status, redo_status = recorder.undo_redo_status()
+    return JsonResponse({"success": True,
+                         "undo": undo_status,
+                         "redo": redo_status,
+                         "diff": diff})
+
+
+def get_paste_sources(source_ids_str, product_id):
+    """
+    移動、複写する構成を source_ids の順に取得する
+    選択した構成の配下も選択されている場合は、配下は頂点と一緒に移動、複写されるので除きます。
+    :param source_ids_str: カンマ区切りのCompositionのID
+    :param product_id: 製品のCompositionのID
+    :return: Compositionオブジェクトのリスト
+    """
+    try:
+        source_ids = list(dict.fromkeys(int(id_str) for id_str in source_ids_str.split(',') if id_str))
+    except ValueError:
+        raise ValueError("移動、複写する構成が不正です。")
+    compositions = {}
+    for chunk in chunked(source_ids):
+        compositions.update((composition.id, composition) for composition in Composition.objects.filter(id__in=chunk))
+    if not source_ids or any(
+        id not in compositions or compositions[id].parent_id is None or compositions[id].path is None
+        or not compositions[id].path.startswith(f'/{product_id}/') for id in source_ids
+    ):
+        raise ValueError("移動、複写する構成が不正です。")
+    paths = [compositions[id].path for id in source_ids]
+    return [compositions[id] for id in source_ids
+            if not any(path != compositions[id].path and compositions[id].path.startswith(path) for path in paths)]
+
+
+# target の前"before"、後"after"、子"children"(末尾)に挿入する際の、親idと並び順を返す。
+def get_paste_position(target, insert_position):
+    if insert_position == 'children':
+        max_sort = Composition.objects.filter(parent_id=target.id).aggregate(max_sort=Max('sort'))['max_sort']
+        return target.id, (max_sort or 0) + 1
+    if target.parent_id is None or insert_position not in ('before', 'after'):
+        raise ValueError("移動先の構成が不正です。")
     if insert_position == 'before':
-        change_compositions = Composition.objects.filter(parent_id=drop_target_composition.parent_id,
-                                                         sort__gte=drop_target_composition.sort
-                                                         ).exclude(id=dragged_id)
-    else:
-        change_compositions = Composition.objects.filter(parent_id=drop_target_composition.parent_id,
-                                                         sort__gt=drop_target_composition.sort
-                                                         ).exclude(id=dragged_id)
-    return change_compositions
+        return target.parent_id, target.sort
+    return target.parent_id, target.sort + 1
+
+
+# compositionsとその配下を、親parent_idの並び順new_sortの位置へ、指定された順に並べて複写する。
+# 複写した頂点のCompositionオブジェクトのリストを返します。
+def copy_compositions(recorder, compositions, parent_id, new_sort):
+    recorder.shift_siblings(parent_id, new_sort, len(compositions))
+    parent_path = Composition.objects.filter(pk=parent_id).values_list('path', flat=True).get()
+    next_id = get_next_composition_id()
+    copies = []
+    for i, composition in enumerate(compositions):
+        rows = build_subtree_copy(composition, next_id, parent_id, parent_path, new_sort + i)
+        recorder.create_subtree(rows)
+        next_id += len(rows)
+        copies.append(Composition(id=rows[0][0], parent_id=parent_id, sort=new_sort + i, part_id=rows[0][3],
+                                  quantity=rows[0][4], path=rows[0][5]))
+    return copies
+
+
+# リクエストがJSONでの応答を要求しているか(画面のJavaScriptからの呼び出しか)を返す。
+def accepts_json(request):
+    return 'application/json' in request.headers.get('Accept', '')
 
 
 # 変更画面の「元に戻す」ボタン処理
 def composition_edit_undo(request, product_id):
+    composition_historys = []
     # 実行
     with transaction.atomic():
-        try:
-            undo_redo_pointer = UndoRedoPointer.objects.get(product=product_id)
+        undo_redo_pointer = UndoRedoPointer.objects.filter(product=product_id).first()
+        undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        if undo_status:
             # undo_redo_pointer.pointerのトランザクション処理を打ち消す。
-            composition_historys = CompositionHistory.objects.filter(composition_change_set=undo_redo_pointer.pointer).order_by('-pk')
-            for composition_history in composition_historys:
-                # 作成
-                if composition_history.action == 'create':
-                    composition_to_delete = Composition.objects.get(pk=composition_history.composition_original_id)
-                    composition_to_delete.delete()
-                # 更新
-                if composition_history.action == 'update' and composition_history.status == 'before':
-                    composition_to_update = Composition.objects.get(pk=composition_history.composition_original_id)
-                    composition_to_update.parent_id = composition_history.parent_original_id
-                    composition_to_update.sort = composition_history.sort
-                    composition_to_update.part = composition_history.part
-                    composition_to_update.quantity = composition_history.quantity
-                    composition_to_update.save()
-                # 削除
-                if composition_history.action == 'delete':
-                    Composition.objects.create(
-                        # historyのidから戻さないと整合性が取れない。
-                        id=composition_history.composition_original_id,
-                        parent_id=composition_history.parent_original_id,
-                        sort=composition_history.sort,
-                        part=composition_history.part,
-                        quantity=composition_history.quantity,
-                    )
-            # 現状のポインタを１つ前のポインタへ戻す。
-            composition = Composition.objects.get(pk=product_id)
-            composition_change_set = CompositionChangeSet.objects.filter(
-                product=composition, pk__lt=undo_redo_pointer.pointer.id
-            ).order_by('-pk').first()
-            # composition_change_setが取れなければundo_redo_pointerを削除。
-            if composition_change_set is None:
-                undo_redo_pointer.delete()
-            else:
-                undo_redo_pointer.pointer = composition_change_set
-                undo_redo_pointer.save()
-        except UndoRedoPointer.DoesNotExist:
-            pass
+            # (製品の作成は元に戻せないので、ポインタが製品の作成を指す場合はここに来ません)
+            composition_historys = undo_execute(undo_redo_pointer.pointer_id)
+            # 現状のポインタを１つ前のポインタへ戻す。(取れなければ null。最初まで戻した状態)
+            undo_redo_pointer.pointer_id = CompositionChangeSet.objects.filter(
+                product=product_id, pk__lt=undo_redo_pointer.pointer_id
+            ).order_by('-pk').values_list('pk', flat=True).first()
+            undo_redo_pointer.save(update_fields=['pointer'])
+            undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        invalidate_tree_cache(product_id)
+        # JSONを要求された場合は、画面のツリーへその場で反映する為の差分のみを返す。
+        if accepts_json(request):
+            return JsonResponse({'success': True, 'undo': undo_status, 'redo': redo_status,
+                                 'diff': get_tree_diff(composition_historys)})
         # 再描画の為のデータを取り出す。
-        nodes = find_by_product_id(product_id)
-        undo_status, redo_status = check_undo_redo(product_id)
+        nodes = get_product_nodes(product_id, get_initial_depth(request))
     return render(request,
                   'part_list_app/composition_edit.html',   # 使用するテンプレート
                   {'product_id': product_id, 'nodes': nodes, 'undo': undo_status, 'redo': redo_status}
@@ -664,52 +1214,31 @@ def composition_edit_undo(request, product_id):
 
 # 変更画面の「やり直し」ボタン処理
 def composition_edit_redo(request, product_id):
+    composition_historys = []
     # 実行
     with transaction.atomic():
-        try:
-            undo_redo_pointer = UndoRedoPointer.objects.get(product=product_id)
-            # undo_redo_pointer.pointerのトランザクション処理を打ち消すを打ち消す。
-            # composition_historys = CompositionHistory.objects.filter(composition_change_set=undo_redo_pointer.pointer).order_by('-pk')
-            # pointerより大きい最初の１件を取り出す。
-            composition = Composition.objects.get(pk=product_id)
-            change_set = CompositionChangeSet.objects.filter(
-                product=composition, pk__gt=undo_redo_pointer.pointer.id
-            ).order_by('pk').first()
-            redo_execute(change_set)
-            # 現状のポインタを１つ後のポインタへ進める。
-            composition = Composition.objects.get(pk=product_id)
-            composition_change_set = CompositionChangeSet.objects.filter(
-                product=composition, pk__gt=undo_redo_pointer.pointer.id
-            ).order_by('pk').first()
-            # composition_change_setが取れない時はここの関数はそもそも呼ばれない。
-            if composition_change_set is None:
-                pass
+        undo_redo_pointer = UndoRedoPointer.objects.filter(product=product_id).first()
+        undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        if redo_status:
+            # pointerより大きい最初の１件を取り出す。(最初まで戻した状態の場合は最初の１件)
+            if undo_redo_pointer.pointer_id is None:
+                change_set_id = undo_redo_pointer.first_change_set_id
             else:
-                undo_redo_pointer.pointer = composition_change_set
-                undo_redo_pointer.save()
-        except UndoRedoPointer.DoesNotExist:
-            # undo_redo_pointerにレコードが存在しなくかつcomposition_change_set
-            # に値が存在する場合、一番若いidの１件のchange_setよりredo処理を実行する。
-            composition = Composition.objects.get(pk=product_id)
-            change_set = CompositionChangeSet.objects.filter(
-                product=composition
-            ).order_by('pk').first()
-            redo_execute(change_set)
+                change_set_id = CompositionChangeSet.objects.filter(
+                    product=product_id, pk__gt=undo_redo_pointer.pointer_id
+                ).order_by('pk').values_list('pk', flat=True).first()
+            composition_historys = redo_execute(change_set_id)
             # 現状のポインタを１つ後のポインタへ進める。
-            composition = Composition.objects.get(pk=product_id)
-            composition_change_set = CompositionChangeSet.objects.filter(
-                product=composition
-            ).order_by('pk').first()
-            # composition_change_setが取れない時はここの関数はそもそも呼ばれない。
-            if composition_change_set is None:
-                pass
-            else:
-                UndoRedoPointer.objects.create(
-                    product=composition,
-                    pointer=composition_change_set
-                )
+            undo_redo_pointer.pointer_id = change_set_id
+            undo_redo_pointer.save(update_fields=['pointer'])
+            undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        invalidate_tree_cache(product_id)
+        # JSONを要求された場合は、画面のツリーへその場で反映する為の差分のみを返す。
+        if accepts_json(request):
+            return JsonResponse({'success': True, 'undo': undo_status, 'redo': redo_status,
+                                 'diff': get_tree_diff(composition_historys)})
         # 再描画の為のデータを取り出す。
-        nodes = find_by_product_id(product_id)
+        nodes = get_product_nodes(product_id, get_initial_depth(request))
         # nodes = []
         # composition = Composition.objects.get(pk=product_id)
         # quantity = 1
@@ -723,118 +1252,707 @@ def composition_edit_redo(request, product_id):
         #     'children': get_children(composition.id, quantity)
         # }
         # nodes.append(dict_data)
-        undo_status, redo_status = check_undo_redo(product_id)
     return render(request,
                   'part_list_app/composition_edit.html',   # 使用するテンプレート
                   {'product_id': product_id, 'nodes': nodes, 'undo': undo_status, 'redo': redo_status}
                   )
 
 
+# 変更画面の「指定した構成変更セットまで元に戻す、やり直し」処理
+# ?change_set_id= で移動先の構成変更セットのid(空の場合は最初の構成変更セットより前まで元に戻す)、
+# または ?steps= で移動する数(負の値は元に戻す、正の値はやり直し)を指定します。
+# 製品の作成より前へは戻さず、製品の作成の構成変更セットで止めます。(製品の削除は「削除」で行います)
+# 間の構成変更セットは1つずつ再生せず、まとめた差分のみを1つのトランザクションで反映します。
+def composition_edit_jump(request, product_id):
+    composition_historys = []
+    # 実行
+    with transaction.atomic():
+        undo_redo_pointer = UndoRedoPointer.objects.filter(product=product_id).first()
+        undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        if undo_redo_pointer is not None:
+            try:
+                change_set_id = get_jump_target(request, undo_redo_pointer)
+            except (ValueError, CompositionChangeSet.DoesNotExist):
+                return JsonResponse({"success": False, "message": "移動先の構成変更セットが不正です。"})
+            composition_historys = jump_execute(undo_redo_pointer, change_set_id)
+            undo_redo_pointer.pointer_id = change_set_id
+            undo_redo_pointer.save(update_fields=['pointer'])
+            undo_status, redo_status = get_undo_redo_status(undo_redo_pointer)
+        invalidate_tree_cache(product_id)
+        # JSONを要求された場合は、画面のツリーへその場で反映する為の差分のみを返す。
+        if accepts_json(request):
+            return JsonResponse({'success': True, 'undo': undo_status, 'redo': redo_status,
+                                 'diff': get_tree_diff(composition_historys)})
+        # 再描画の為のデータを取り出す。
+        nodes = get_product_nodes(product_id, get_initial_depth(request))
+    return render(request,
+                  'part_list_app/composition_edit.html',   # 使用するテンプレート
+                  {'product_id': product_id, 'nodes': nodes, 'undo': undo_status, 'redo': redo_status}
+                  )
+
+
+# 「指定した構成変更セットまで元に戻す、やり直し」の移動先の構成変更セットのidを返す。
+# 最初の構成変更セットより前まで元に戻す場合はNoneを返します。
+# (製品の作成の構成変更セットがある場合は、それより前へは戻さずそのidを返します)
+def get_jump_target(request, undo_redo_pointer):
+    change_set_id = get_jump_target_id(request, undo_redo_pointer)
+    creation_change_set_id = undo_redo_pointer.creation_change_set_id
+    if creation_change_set_id is not None and (change_set_id is None or change_set_id < creation_change_set_id):
+        return creation_change_set_id
+    return change_set_id
+
+
+def get_jump_target_id(request, undo_redo_pointer):
+    change_sets = CompositionChangeSet.objects.filter(product=undo_redo_pointer.product_id)
+    pointer_id = undo_redo_pointer.pointer_id
+    if 'steps' in request.GET:
+        steps = int(request.GET['steps'])
+        if steps < 0:
+            # ポインタから前へ数えて -steps 件戻した位置。足りなければ最初より前。
+            if pointer_id is None:
+                return None
+            change_set_ids = list(change_sets.filter(pk__lte=pointer_id).order_by('-pk').values_list(
+                'pk', flat=True
+            )[:1 - steps])
+            return change_set_ids[-steps] if len(change_set_ids) > -steps else None
+        if steps > 0:
+            # ポインタから後ろへ数えて steps 件進めた位置。足りなければ最後。
+            if pointer_id is not None:
+                change_sets = change_sets.filter(pk__gt=pointer_id)
+            change_set_ids = list(change_sets.order_by('pk').values_list('pk', flat=True)[:steps])
+            return change_set_ids[-1] if change_set_ids else pointer_id
+        return pointer_id
+    change_set_id = request.GET.get('change_set_id')
+    if not change_set_id:
+        return None
+    return change_sets.values_list('pk', flat=True).get(pk=int(change_set_id))
+
+
+# ポインタの位置からchange_set_idの構成変更セットの位置まで、間の構成変更セットの履歴をまとめて反映する。
+# change_set_idがポインタより前なら元に戻し、後ろならやり直します。反映した履歴のリストを返します。
+def jump_execute(undo_redo_pointer, change_set_id):
+    pointer_id = undo_redo_pointer.pointer_id
+    composition_historys = CompositionHistory.objects.filter(
+        composition_change_set__product=undo_redo_pointer.product_id
+    )
+    if change_set_id is None or (pointer_id is not None and change_set_id < pointer_id):
+        # 元に戻す: change_set_id < 構成変更セット <= pointer_id
+        if pointer_id is None:
+            return []
+        composition_historys = composition_historys.filter(composition_change_set__lte=pointer_id)
+        if change_set_id is not None:
+            composition_historys = composition_historys.filter(composition_change_set__gt=change_set_id)
+        # 履歴は反映後に部品の隣接関係、画面の差分でも使う為、先にリストとして読み込んでおく。
+        composition_historys = list(composition_historys.order_by('-composition_change_set', '-pk'))
+        replay_histories(composition_historys, undo=True)
+        update_part_adjacency_from_histories(composition_historys, -1)
+        update_composition_paths_from_histories(composition_historys)
+        return composition_historys
+    # やり直し: pointer_id < 構成変更セット <= change_set_id
+    if pointer_id is not None:
+        composition_historys = composition_historys.filter(composition_change_set__gt=pointer_id)
+    composition_historys = list(
+        composition_historys.filter(composition_change_set__lte=change_set_id).order_by('composition_change_set', 'pk')
+    )
+    replay_histories(composition_historys)
+    update_part_adjacency_from_histories(composition_historys)
+    update_composition_paths_from_histories(composition_historys)
+    return composition_historys
+
+
 def redo_execute(change_set):
-    composition_historys = CompositionHistory.objects.filter(composition_change_set=change_set).order_by('pk')
-    for composition_history in composition_historys:
-        # 作成
-        if composition_history.action == 'create':
-            Composition.objects.create(
+    composition_historys = list(
+        CompositionHistory.objects.filter(composition_change_set=change_set).order_by('pk')
+    )
+    replay_histories(composition_historys)
+    update_part_adjacency_from_histories(composition_historys)
+    update_composition_paths_from_histories(composition_historys)
+    return composition_historys
+
+
+def undo_execute(change_set):
+    # 履歴は反映後に部品の隣接関係、画面の差分でも使う為、先にリストとして読み込んでおく。
+    composition_historys = list(
+        CompositionHistory.objects.filter(composition_change_set=change_set).order_by('-pk')
+    )
+    replay_histories(composition_historys, undo=True)
+    update_part_adjacency_from_histories(composition_historys, -1)
+    update_composition_paths_from_histories(composition_historys)
+    return composition_historys
+
+
+# 履歴の操作と「元に戻す」(undo=True)、「やり直し」(undo=False)より、Compositionに行う操作を返す。
+# 'update' の履歴は、元に戻す場合は'before'、やり直す場合は'after'の値を使います。
+def get_replay_operation(history, undo):
+    if history.action == 'update':
+        if history.status == ('before' if undo else 'after'):
+            return 'update'
+        return None
+    if history.action == 'create':
+        return 'delete' if undo else 'create'
+    if history.action == 'delete':
+        return 'create' if undo else 'delete'
+    return None
+
+
+def replay_histories(histories, undo=False):
+    """
+    CompositionHistoryの内容をCompositionへまとめて反映する。
+    同じCompositionへの操作は最終的な状態の1件にまとめ、作成は bulk_create(履歴のidのまま)、
+    更新は bulk_update、削除は QUERY_CHUNK_SIZE 件毎の delete で反映します。
+    'shift' は兄弟の並び順をその時点の値からずらす為、履歴の順に実行し、各Compositionの最終的な状態は
+    そのCompositionの最後の操作の位置('shift' の前後)で反映します。
+    それより前の操作は最後の操作で上書きされるので、複数の構成変更セットの履歴をまとめて渡しても
+    Composition毎に1回だけ書き込みます。発行するクエリ数は履歴の件数ではなく、'shift' の件数に比例します。
+    :param histories: 反映する順に並べた履歴(やり直しはpk順、元に戻す場合はpkの逆順)
+    :param undo: 履歴を打ち消す方向に反映する場合はTrue
+    """
+    # id→反映前にCompositionが存在したか
+    existed = {}
+    # id→反映後のComposition(削除する場合はNone)
+    rows = {}
+    # id→最後の操作より前に実行する 'shift' の数
+    segments = {}
+    shifts = []
+    for history in histories:
+        if history.action == 'shift':
+            shifts.append(history)
+            continue
+        operation = get_replay_operation(history, undo)
+        if operation is None:
+            continue
+        id = history.composition_original_id
+        if id not in existed:
+            existed[id] = operation != 'create'
+        if operation == 'delete':
+            rows[id] = None
+        else:
+            rows[id] = Composition(
                 # historyのidから戻さないと整合性が取れない。
-                id=composition_history.composition_original_id,
-                parent_id=composition_history.parent_original_id,
-                sort=composition_history.sort,
-                part=composition_history.part,
-                quantity=composition_history.quantity,
+                id=id,
+                parent_id=history.parent_original_id,
+                sort=history.sort,
+                part_id=history.part_id,
+                quantity=history.quantity,
             )
-        # 更新
-        if composition_history.action == 'update' and composition_history.status == 'after':
-            composition_to_update = Composition.objects.get(pk=composition_history.composition_original_id)
-            composition_to_update.parent_id = composition_history.parent_original_id
-            composition_to_update.sort = composition_history.sort
-            composition_to_update.part = composition_history.part
-            composition_to_update.quantity = composition_history.quantity
-            composition_to_update.save()
-        # 削除
-        if composition_history.action == 'delete':
-            composition_to_delete = Composition.objects.get(pk=composition_history.composition_original_id)
-            composition_to_delete.delete()
+        segments[id] = len(shifts)
+
+    segment_rows = [{} for _ in range(len(shifts) + 1)]
+    for id, row in rows.items():
+        segment_rows[segments[id]][id] = row
+    for segment, shift in enumerate(shifts):
+        apply_replay_rows(existed, segment_rows[segment])
+        if undo:
+            Composition.objects.filter(
+                parent_id=shift.parent_original_id,
+                sort__gte=shift.sort + shift.quantity
+            ).update(sort=F('sort') - shift.quantity)
+        else:
+            Composition.objects.filter(
+                parent_id=shift.parent_original_id,
+                sort__gte=shift.sort
+            ).update(sort=F('sort') + shift.quantity)
+    apply_replay_rows(existed, segment_rows[-1])
+
+
+# replay_histories でまとめた操作を、削除、更新、作成の順にまとめて反映する。
+def apply_replay_rows(existed, rows):
+    deleted_ids = [id for id, row in rows.items() if row is None and existed[id]]
+    updated_rows = [row for id, row in rows.items() if row is not None and existed[id]]
+    created_rows = [row for id, row in rows.items() if row is not None and not existed[id]]
+    for chunk in chunked(deleted_ids):
+        Composition.objects.filter(id__in=chunk).delete()
+    Composition.objects.bulk_update(updated_rows, ['parent_id', 'sort', 'part', 'quantity'],
+                                    batch_size=QUERY_CHUNK_SIZE)
+    Composition.objects.bulk_create(created_rows, batch_size=QUERY_CHUNK_SIZE)
 
 
 # undoRedoPointerの値よりCompositionChangeSet、CompositionHistoryの値を再更新する。
+# 取得したUndoRedoPointerを返します。(無ければNone)
 def update_history_from_pointer(product_id):
     # ポインタより大きな値のCompositionChangeSet、CompositionHistoryインスタンスがあればそちらは削除する。
     # その後、新しいCompositionChangeSet、CompositionHistoryインスタンスを追加する。
-    try:
-        undo_redo_pointer = UndoRedoPointer.objects.get(product=product_id)
-        composition_change_sets = CompositionChangeSet.objects.filter(
-            product=undo_redo_pointer.product,
-            id__gt=undo_redo_pointer.pointer.id
-        )
-        for change_set in composition_change_sets:
-            # 以下はForeignKeyでcomposition_change_setつながっているのであえて削除しなくても
-            # composition_change_setが削除されるとこちらも消えるはず。
-            # CompositionHistory.objects.filter(composition_change_set=change_set).delete()
-            change_set.delete()
-    except UndoRedoPointer.DoesNotExist:
-        # UndoRedoPointerが存在しないけれどもCompositionChangeSet、CompositionHistoryが存在する場合
-        # CompositionChangeSet、CompositionHistoryを削除する。
-        composition = Composition.objects.get(id=product_id)
-        composition_change_sets = CompositionChangeSet.objects.filter(
-            product=composition
-        )
-        for change_set in composition_change_sets:
-            # 以下はForeignKeyでcomposition_change_setつながっているのであえて削除しなくても
-            # composition_change_setが削除されるとこちらも消えるはず。
-            # CompositionHistory.objects.filter(composition_change_set=change_set).delete()
-            change_set.delete()
+    undo_redo_pointer = UndoRedoPointer.objects.filter(product=product_id).first()
+    if undo_redo_pointer is None:
+        return None
+    # やり直し出来る構成変更セットが無ければ削除するものは無い。
+    if not get_undo_redo_status(undo_redo_pointer)[1]:
+        return undo_redo_pointer
+    composition_change_sets = CompositionChangeSet.objects.filter(product=product_id)
+    if undo_redo_pointer.pointer_id is not None:
+        composition_change_sets = composition_change_sets.filter(id__gt=undo_redo_pointer.pointer_id)
+    started = time.monotonic()
+    change_set_count, history_count = delete_change_sets(composition_change_sets)
+    logger.debug('product %s: truncated %d change sets and %d histories after pointer %s in %.3fs',
+                 product_id, change_set_count, history_count, undo_redo_pointer.pointer_id,
+                 time.monotonic() - started)
+    # 最後の構成変更セットはポインタの位置になる。(最初まで戻した状態の場合は全て削除されている)
+    undo_redo_pointer.last_change_set_id = undo_redo_pointer.pointer_id
+    if undo_redo_pointer.pointer_id is None:
+        undo_redo_pointer.first_change_set_id = None
+        undo_redo_pointer.creation_change_set_id = None
+    undo_redo_pointer.save(update_fields=['first_change_set_id', 'last_change_set_id', 'creation_change_set_id'])
+    return undo_redo_pointer
+
+
+# 構成変更セットとその履歴をまとめて削除し、(削除した構成変更セットの件数, 削除した履歴の件数)を返す。
+# 構成変更セットを1件ずつ削除すると、ForeignKeyのCASCADEで履歴を1件ずつ集めて削除する事になる為、
+# 先に履歴を1回のDELETEでまとめて削除し、その後に構成変更セットをまとめて削除する。
+# (発行するクエリ数は削除する構成変更セットの件数によらず、ほぼ一定です)
+def delete_change_sets(composition_change_sets):
+    history_count = CompositionHistory.objects.filter(
+        composition_change_set__in=composition_change_sets.values('id')
+    ).delete()[0]
+    change_set_count = composition_change_sets.delete()[0]
+    return change_set_count, history_count
+
+
+def compact_history(product_id, retention=None):
+    """
+    製品の構成履歴を圧縮する。
+    - ポインタ以前の構成変更セットは新しいものから retention 件を残し、それより古いものは削除します。
+      削除した構成変更セットより前へは元に戻せなくなり、現在の構成がその基準になります。
+    - 元に戻せる構成変更セット(ポインタ以前で残したもの)から、更新前後で値の変わらない 'update' の履歴の組を
+      削除します。やり直し出来る構成変更セットの履歴は読みません。
+    - 履歴が無くなった構成変更セット(ポインタの指すものを除く)を削除します。
+    残した構成変更セットの範囲の履歴のみを読むので、処理量は履歴全体ではなく retention に比例します。
+    :param product_id: 製品のid
+    :param retention: 元に戻せる構成変更セットの件数。省略時は設定の PART_LIST_HISTORY_RETENTION
+                      (None の場合は古い構成変更セットを削除しません)
+    :return: (削除した構成変更セットの件数, 削除した履歴の件数)
+    """
+    if retention is None:
+        retention = getattr(settings, 'PART_LIST_HISTORY_RETENTION', None)
+    change_set_count = history_count = 0
+    with transaction.atomic():
+        undo_redo_pointer = UndoRedoPointer.objects.filter(product=product_id).first()
+        if undo_redo_pointer is None:
+            return change_set_count, history_count
+        composition_change_sets = CompositionChangeSet.objects.filter(product=product_id)
+
+        # 元に戻せる構成変更セットの内、一番古いもののid(None の場合はポインタ以前の全て)
+        oldest_retained_id = None
+        # 保持する件数より古い構成変更セットを削除する。
+        if retention is not None and undo_redo_pointer.pointer_id is not None:
+            expired_change_sets = composition_change_sets.filter(pk__lte=undo_redo_pointer.pointer_id)
+            if retention > 0:
+                # 残す構成変更セットの内、一番古いもののidより前を削除する。
+                retained_ids = list(expired_change_sets.order_by('-pk').values_list(
+                    'pk', flat=True
+                )[retention - 1:retention])
+                if retained_ids:
+                    oldest_retained_id = retained_ids[0]
+                    expired_change_sets = expired_change_sets.filter(pk__lt=oldest_retained_id)
+                else:
+                    expired_change_sets = expired_change_sets.none()
+            else:
+                # ポインタの構成変更セットも削除するので、削除される前にポインタを外す。
+                undo_redo_pointer.pointer_id = None
+                undo_redo_pointer.save(update_fields=['pointer'])
+            change_set_count, history_count = delete_change_sets(expired_change_sets)
+
+        # 元に戻せる構成変更セットの範囲で、更新前後で値の変わらない 'update' の履歴の組を削除する。
+        # ('before' の直後に同じCompositionの 'after' を記録しているので、連続する2件を比べます)
+        redundant_ids = []
+        previous = None
+        retained_histories = CompositionHistory.objects.none()
+        if undo_redo_pointer.pointer_id is not None:
+            retained_histories = CompositionHistory.objects.filter(
+                composition_change_set__product=product_id,
+                composition_change_set__lte=undo_redo_pointer.pointer_id
+            )
+            if oldest_retained_id is not None:
+                retained_histories = retained_histories.filter(composition_change_set__gte=oldest_retained_id)
+        for history in retained_histories.filter(action='update').order_by('pk').values_list(
+            'id', 'composition_change_set_id', 'composition_original_id', 'status',
+            'parent_original_id', 'sort', 'part_id', 'quantity'
+        ).iterator(chunk_size=QUERY_CHUNK_SIZE):
+            if (previous is not None and previous[3] == 'before' and history[3] == 'after'
+                    and previous[1:3] == history[1:3] and previous[4:] == history[4:]):
+                redundant_ids.extend([previous[0], history[0]])
+                previous = None
+                continue
+            previous = history
+        for chunk in chunked(redundant_ids):
+            history_count += CompositionHistory.objects.filter(id__in=chunk).delete()[0]
+
+        # 履歴が無くなった構成変更セットを削除する。
+        empty_change_sets = composition_change_sets.filter(composition_histories__isnull=True)
+        if undo_redo_pointer.pointer_id is not None:
+            empty_change_sets = empty_change_sets.exclude(pk=undo_redo_pointer.pointer_id)
+        change_set_count += empty_change_sets.delete()[0]
+
+        # 最初、最後の構成変更セットのidを残った構成変更セットより設定し直す。
+        # (製品の作成の構成変更セットを削除した場合は、その時点の構成が基準になるので外します)
+        change_set_range = composition_change_sets.aggregate(first_id=Min('pk'), last_id=Max('pk'))
+        undo_redo_pointer.first_change_set_id = change_set_range['first_id']
+        undo_redo_pointer.last_change_set_id = change_set_range['last_id']
+        if undo_redo_pointer.creation_change_set_id is not None and (
+            change_set_range['first_id'] is None
+            or undo_redo_pointer.creation_change_set_id < change_set_range['first_id']
+        ):
+            undo_redo_pointer.creation_change_set_id = None
+        undo_redo_pointer.save(update_fields=['first_change_set_id', 'last_change_set_id', 'creation_change_set_id'])
+    if change_set_count or history_count:
+        invalidate_tree_cache(product_id)
+    return change_set_count, history_count
 
 
 def check_undo_redo(product_id):
     if product_id is None:
-        undo = False
-        redo = False
-    else:
-        # product_idよりUndoRedoPointerを参照
-        # データが存在する場合、undo変数をTrue
-        # データが存在しない場合、undo変数をFalse
-        # データが存在しかつpointerより大きい値のCompositionChangeSetのidが存在する場合、redo変数をTrueにする。
-        # データが存在しかつpointerより大きい値のCompositionChangeSetのidが存在しない場合、redo変数をFalseにする。
-        # データが存在しないかつCompositionChangeSetが存在する場合、redo変数をTrueにする。
-        # データが存在しないかつCompositionChangeSetが存在しない場合、redo変数をFalseにする。
-        composition = Composition.objects.get(pk=product_id)
-        try:
-            undo_redo_pointer = UndoRedoPointer.objects.get(product=composition)
-            undo = True
-            entries = CompositionChangeSet.objects.filter(product=composition, pk__gt=undo_redo_pointer.pointer.id)
-            if entries.exists():
-                redo = True
-            else:
-                redo = False
-        except UndoRedoPointer.DoesNotExist:
-            undo = False
-            entries = CompositionChangeSet.objects.filter(product=composition)
-            if entries.exists():
-                redo = True
-            else:
-                redo = False
-
+        return False, False
+    return get_undo_redo_status(UndoRedoPointer.objects.filter(product=product_id).first())
+
+
+# UndoRedoPointerの最初、最後、製品の作成の構成変更セットのidとポインタより、「元に戻す」、「やり直し」が出来るかを返す。
+# (クエリは発行しないので、構成を変更した後に UndoRedoPointer を持っていればそのまま判定出来ます)
+def get_undo_redo_status(undo_redo_pointer):
+    if undo_redo_pointer is None:
+        return False, False
+    # ポインタがあれば元に戻せる。ただし製品の作成は元に戻さない。(製品の削除は「削除」で行います)
+    undo = undo_redo_pointer.pointer_id is not None and (
+        undo_redo_pointer.pointer_id != undo_redo_pointer.creation_change_set_id
+    )
+    # ポインタより後ろ(ポインタが無い場合は最初から)に構成変更セットがあればやり直せる。
+    redo = undo_redo_pointer.last_change_set_id is not None and (
+        undo_redo_pointer.pointer_id is None or undo_redo_pointer.pointer_id < undo_redo_pointer.last_change_set_id
+    )
     return undo, redo
 
 
-def find_by_product_id(product_id):
+# 構成変更セットの履歴が、指定した製品自体を作成したものかを返す。
+def is_product_created(histories, product_id):
+    return any(
+        history.action == 'create' and history.composition_original_id == product_id for history in histories
+    )
+
+
+# 製品の構成ツリーをキャッシュより取り出す。無ければ組み立ててキャッシュします。
+# 同じ製品を繰り返し表示する場合は、Compositionを読まずに済みます。
+def get_product_nodes(product_id, depth=None):
+    cache_key = f'{get_tree_cache_key(product_id)}:{depth}'
+    nodes = cache.get(cache_key)
+    if nodes is None:
+        nodes = find_by_product_id(product_id, depth)
+        cache.set(cache_key, nodes)
+    return nodes
+
+
+# 構成ツリーのキャッシュのキー(製品のid、製品毎の世代、部品の世代、UndoRedoPointerのpointer_id)を返す。
+# pointer_idが変わらない変更(製品の削除など)は、invalidate_tree_cacheで世代を変えて無効にします。
+# ツリーには部品コード、部品名も含むので、部品の変更(invalidate_part_cache)でも無効になります。
+def get_tree_cache_key(product_id):
+    generation = get_cache_generation(f'part_list_app:tree_generation:{product_id}')
+    part_generation = get_cache_generation(PART_GENERATION_KEY)
+    pointer_id = UndoRedoPointer.objects.filter(product=product_id).values_list('pointer_id', flat=True).first()
+    return f'part_list_app:tree:{product_id}:{generation}:{part_generation}:{pointer_id}'
+
+
+# キャッシュの世代を返す。(無ければ新しい世代を作成します)
+def get_cache_generation(generation_key):
+    generation = cache.get(generation_key)
+    if generation is None:
+        cache.add(generation_key, uuid.uuid4().hex, None)
+        generation = cache.get(generation_key)
+    return generation
+
+
+# 製品の構成ツリーのキャッシュを無効にする。構成を変更する処理から呼び出します。
+def invalidate_tree_cache(product_id):
+    cache.set(f'part_list_app:tree_generation:{product_id}', uuid.uuid4().hex, None)
+
+
+# 部品コードより部品を取り出す。(無ければNone)
+# 部品コード毎のid、部品名をキャッシュするので、同じ部品コードを繰り返し指定する場合は Part を読まずに済みます。
+# 返す Part は id、code、name のみを設定したものです。
+def get_part_by_code(code):
+    if not code:
+        return None
+    cache_key = f'part_list_app:part_code:{get_cache_generation(PART_GENERATION_KEY)}:{code}'
+    values = cache.get(cache_key)
+    if values is None:
+        values = Part.objects.filter(code=code).values_list('id', 'name').first()
+        if values is None:
+            return None
+        cache.set(cache_key, values)
+    return Part(id=values[0], code=code, name=values[1])
+
+
+# 部品コードのキャッシュと、部品を含む構成ツリーのキャッシュを無効にする。
+# Part の post_save、post_delete のシグナルより呼び出します。(apps.py)
+# シグナルの発生しない bulk_create、update などで部品を変更した場合は直接呼び出して下さい。
+def invalidate_part_cache(sender=None, **kwargs):
+    cache.set(PART_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def get_tree_diff(histories):
+    """
+    CompositionHistoryで変更されたCompositionについて、画面のツリーへその場で反映する為の差分を返す
+    ツリー全体は読み直さず、変更されたCompositionとその親、製品までの祖先のみを取得します。
+    :param histories: 反映したCompositionChangeSet(1つ以上)の CompositionHistory のリスト
+    :return: removed(無くなったid), parents(親id→子のidの並び順のリスト),
+             nodes(変更されたCompositionの内容と実使用数)の辞書
+    """
+    touched_ids = set()
+    parent_ids = set()
+    for history in histories:
+        if history.parent_original_id is not None:
+            parent_ids.add(history.parent_original_id)
+        if history.action != 'shift':
+            touched_ids.add(history.composition_original_id)
+
+    rows = {}
+    for chunk in chunked(list(touched_ids | parent_ids)):
+        for row in Composition.objects.filter(id__in=chunk).values_list(*COMPOSITION_ROW_FIELDS):
+            rows[row[0]] = row
+    load_ancestor_rows(rows)
+
+    children = {}
+    for chunk in chunked([id for id in parent_ids if id in rows]):
+        for id, parent_id in Composition.objects.filter(
+            parent_id__in=chunk
+        ).order_by('parent_id', 'sort').values_list('id', 'parent_id'):
+            children.setdefault(parent_id, []).append(id)
+
+    node_ids = sorted(id for id in touched_ids if id in rows)
+    parts = {}
+    for chunk in chunked(list({rows[id][2] for id in node_ids})):
+        for part_id, code, name in Part.objects.filter(id__in=chunk).values_list('id', 'code', 'name'):
+            parts[part_id] = (code, name)
+    usedquantities = get_usedquantities(rows, node_ids)
+    child_counts = get_child_counts(node_ids)
     nodes = []
-    composition = Composition.objects.get(pk=product_id)
+    for id in node_ids:
+        id, parent_id, part_id, quantity, sort, path = rows[id]
+        nodes.append({
+            'id': id,
+            'parent_id': parent_id,
+            'sort': sort,
+            'code': parts[part_id][0],
+            'name': parts[part_id][1],
+            'quantity': quantity if parent_id is not None else 1,
+            'usedquantity': usedquantities[id],
+            'child_count': child_counts.get(id, 0)
+        })
+    return {
+        'removed': sorted(touched_ids - rows.keys()),
+        'parents': {id: children.get(id, []) for id in sorted(parent_ids) if id in rows},
+        'nodes': nodes
+    }
+
+
+# load_ancestor_rowsで製品まで取得済みのrowsより、idsの各Compositionの実使用数を求める。
+# (製品の実使用数は1。求めた祖先の実使用数は使い回します)
+def get_usedquantities(rows, ids):
+    usedquantities = {}
+    for id in ids:
+        chain = []
+        chain_ids = set()
+        while id not in usedquantities and id in rows and id not in chain_ids:
+            chain.append(id)
+            chain_ids.add(id)
+            if rows[id][1] is None:
+                break
+            id = rows[id][1]
+        usedquantity = usedquantities.get(id)
+        for id in reversed(chain):
+            if rows[id][1] is None:
+                usedquantity = 1
+            elif usedquantity is not None:
+                usedquantity = usedquantity * rows[id][3]
+            usedquantities[id] = usedquantity
+    return usedquantities
+
+
+def find_by_product_id(product_id, depth=None):
+    nodes = []
+    composition = Composition.objects.select_related('part').get(pk=product_id)
     quantity = 1
     usedquantity = 1
+    # 製品配下の構成を階層毎にまとめて取得してから、メモリ上で階層構造を組み立てる。
+    children_map = get_children_map(composition.id, depth)
+    child_counts = {}
+    if depth is not None:
+        # 読み込んだ最下層の要素は子の件数のみを取得しておき、子は展開した時に読み込む。
+        level_ids = [composition.id]
+        for i in range(depth):
+            level_ids = [child.id for id in level_ids for child in children_map.get(id, [])]
+        child_counts = get_child_counts(level_ids)
     dict_data = {
         'id': composition.id,
         'code': composition.part.code,
         'name': composition.part.name,
         'quantity': quantity,
         'usedquantity': usedquantity,
-        'children': get_children(composition.id, quantity)
+        'child_count': len(children_map.get(composition.id, [])),
+        'children': get_children(composition.id, quantity, children_map, child_counts)
     }
     nodes.append(dict_data)
     return nodes
 
 
+# 変更画面の部品展開(所要量集計)処理
+# format=csv(既定) もしくは format=jsonl で、部品毎の所要量を逐次出力します。
+def composition_explosion(request, product_id):
+    output_format = request.GET.get('format', 'csv')
+    product = Composition.objects.select_related('part').get(pk=product_id)
+    rows = get_bom_explosion(product.id)
+    if output_format == 'jsonl':
+        lines = (json.dumps({'code': code, 'name': name, 'usedquantity': usedquantity}, ensure_ascii=False) + '\n'
+                 for code, name, usedquantity in rows)
+        return StreamingHttpResponse(lines, content_type='application/jsonl; charset=utf-8')
+    writer = csv.writer(Echo())
+    lines = (writer.writerow(row) for row in [('code', 'name', 'usedquantity')] + rows)
+    response = StreamingHttpResponse(lines, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{product.part.code}_explosion.csv"'
+    return response
+
+
+# csv.writerの書き込み先。書き込まれた行をそのまま返し、StreamingHttpResponseへ渡します。
+class Echo:
+    def write(self, value):
+        return value
+
+
+def get_bom_explosion(product_id):
+    """
+    製品配下の全階層の構成を部品毎にまとめ、員数を掛け合わせた所要量の合計を返す
+    階層毎にまとめて取得しながら所要量を累計するので、入れ子の構造は組み立てません。
+    :param product_id: 製品のCompositionのID
+    :return: (部品コード, 部品名, 所要量)の部品コード順のリスト
+    """
+    totals = Counter()
+    usedquantities = {product_id: 1}
+    visited_ids = {product_id}
+    while usedquantities:
+        next_usedquantities = {}
+        for chunk in chunked(list(usedquantities)):
+            for id, parent_id, part_id, quantity in Composition.objects.filter(
+                parent_id__in=chunk
+            ).values_list('id', 'parent_id', 'part_id', 'quantity'):
+                if id in visited_ids:
+                    continue
+                visited_ids.add(id)
+                usedquantity = usedquantities[parent_id] * quantity
+                totals[part_id] += usedquantity
+                next_usedquantities[id] = usedquantity
+        usedquantities = next_usedquantities
+
+    rows = []
+    for chunk in chunked(list(totals)):
+        for part_id, code, name in Part.objects.filter(id__in=chunk).values_list('id', 'code', 'name'):
+            rows.append((code, name, totals[part_id]))
+    rows.sort()
+    return rows
+
+
+# 構成表の出力の列(製品は level 0 で、import_bom の indented の形式で読み込めます)
+BOM_EXPORT_FIELDS = ('level', 'code', 'name', 'quantity', 'usedquantity')
+
+
+# 一覧画面(selectedIds で複数の製品)、変更画面の構成表の出力処理
+# format=csv(既定)、format=excel(Excel用にBOM付きのCSV)、format=jsonl で、変更画面と同じ順に逐次出力します。
+def composition_export(request, product_id=None):
+    output_format = request.GET.get('format', 'csv')
+    if product_id is not None:
+        product_ids = [product_id]
+    else:
+        selected_ids_str = request.GET.get('selectedIds', '')
+        product_ids = [int(id_str) for id_str in selected_ids_str.split(',') if id_str]
+    lines = iter_bom_export_lines(product_ids, output_format)
+    if output_format == 'jsonl':
+        return StreamingHttpResponse(lines, content_type='application/jsonl; charset=utf-8')
+    response = StreamingHttpResponse(lines, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="bom.csv"'
+    return response
+
+
+# 製品毎の構成表を、出力形式の1行毎の文字列で返す。(export_bom コマンドからも呼び出します)
+def iter_bom_export_lines(product_ids, output_format='csv'):
+    if output_format == 'jsonl':
+        for product_id in product_ids:
+            for row in iter_bom_rows(product_id):
+                yield json.dumps(dict(zip(BOM_EXPORT_FIELDS, row)), ensure_ascii=False) + '\n'
+        return
+    if output_format == 'excel':
+        yield '\ufeff'
+    writer = csv.writer(Echo())
+    yield writer.writerow(BOM_EXPORT_FIELDS)
+    for product_id in product_ids:
+        for row in iter_bom_rows(product_id):
+            yield writer.writerow(row)
+
+
+def iter_bom_rows(product_id):
+    """
+    製品の構成を、変更画面と同じ順(深さ優先、兄弟は sort 順)に1行ずつ返す
+    入れ子の構造は組み立てず、子は出力順に BOM_EXPORT_BUFFER_SIZE 件程ずつ先読みし、
+    出力した行は読み捨てるので、製品の大きさに関わらずメモリはほぼ一定です。
+    :param product_id: 製品のCompositionのID
+    :return: (階層, 部品コード, 部品名, 数, 所要量)を返すジェネレータ(製品は階層0、数と所要量は1)
+    """
+    id, code, name = Composition.objects.filter(pk=product_id).values_list('id', 'part__code', 'part__name').get()
+    yield 0, code, name, 1, 1
+    children_map = {}   # 先読みした親id→子のリスト
+    frontier = load_children_rows([id], children_map)
+    # [兄弟のリスト, 次の兄弟の位置, 階層, 親の所要量]
+    stack = [[children_map.pop(id), 0, 1, 1]]
+    while stack:
+        frame = stack[-1]
+        siblings, position, level, parent_usedquantity = frame
+        if position >= len(siblings):
+            stack.pop()
+            continue
+        frame[1] = position + 1
+        id, code, name, quantity = siblings[position]
+        usedquantity = parent_usedquantity * quantity
+        yield level, code, name, quantity, usedquantity
+        if id not in children_map:
+            # 子を先読みしていない要素は、先読みの境界(frontier)の先頭なので、続きを先読みする。
+            frontier = load_children_rows(frontier, children_map)
+        children = children_map.pop(id)
+        if children:
+            stack.append([children, 0, level + 1, usedquantity])
+
+
+# 構成表の出力で1回に先読みするCompositionの件数の目安
+BOM_EXPORT_BUFFER_SIZE = 5000
+
+
+def load_children_rows(frontier, children_map):
+    """
+    先読みの境界(子を読み込んでいないCompositionの出力順のidのリスト)の先頭から、
+    QUERY_CHUNK_SIZE 件毎に子を読み込み、BOM_EXPORT_BUFFER_SIZE 件程までchildren_mapへ先読みする
+    読み込んだidは境界から外れ、その子(sort順)が同じ位置に入るので、境界は出力順のまま保たれます。
+    :param frontier: 先読みの境界のidのリスト
+    :param children_map: 親id→子の(id, 部品コード, 部品名, 数)のリスト(子が無い場合は空のリスト)
+    :return: 先読みした後の境界のidのリスト
+    """
+    count = 0
+    while frontier and count < BOM_EXPORT_BUFFER_SIZE:
+        chunk = frontier[:QUERY_CHUNK_SIZE]
+        children_rows = get_children_rows(chunk)
+        next_ids = []
+        for id in chunk:
+            children = children_rows.get(id, [])
+            children_map[id] = children
+            count += len(children)
+            next_ids.extend(child[0] for child in children)
+        frontier = next_ids + frontier[QUERY_CHUNK_SIZE:]
+    return frontier
+
+
+# 指定したidのCompositionの子を、親id→子の(id, 部品コード, 部品名, 数)のリスト(sort順)で返す。
+def get_children_rows(ids):
+    children_rows = {}
+    for chunk in chunked(ids):
+        for parent_id, id, code, name, quantity in Composition.objects.filter(parent_id__in=chunk).order_by(
+            'parent_id', 'sort'
+        ).values_list('parent_id', 'id', 'part__code', 'part__name', 'quantity').iterator():
+            children_rows.setdefault(parent_id, []).append((id, code, name, quantity))
+    return children_rows
+
+
 # 一覧画面の削除処理
 def product_del(request):
     # GETパラメータから selectedIds を取得
@@ -847,47 +1965,228 @@ def product_del(request):
         for id_str in selected_ids_list:
             # 選択行のインスタンスを取得
             current_composition = Composition.objects.get(pk=id_str)
-            # 選択された行のidの子を取得する。
-            children_data = delete_childrens(current_composition.id)
-            # 取得された子のデータをフラットにしてならべる
-            all_children = get_all_children(children_data)
-            # 全ての子を削除する
-            for child in all_children:
-                child_composition = Composition.objects.get(pk=child['id'])
-                child_composition.delete()
-            current_composition.delete()
+            # 選択された製品とその子を全て削除する
+            delete_subtree(current_composition)
+            invalidate_tree_cache(current_composition.id)
     # ProductListビューにリダイレクト
     return HttpResponseRedirect(reverse('part_list_app:product_list'))
 
 
-def is_cyclic_part(id, part_id, visited_parts):
+# 一覧画面の使用先検索(逆展開)処理
+def product_where_used(request):
+    edit_block_code = request.GET.get("edit_block_code")
+    try:
+        # エラーチェック
+        part_instance = get_part_by_code(edit_block_code)
+        if part_instance is None:
+            raise ValueError("存在しない部品が指定されました。")
+        # 実行
+        products = get_where_used([part_instance.id])
+    except ValueError as e:
+        return JsonResponse({"success": False, "message": str(e)})
+    return JsonResponse({"success": True, "products": products})
+
+
+# load_ancestor_rowsなどで扱うCompositionの行の項目
+COMPOSITION_ROW_FIELDS = ('id', 'parent_id', 'part_id', 'quantity', 'sort', 'path')
+
+
+# rows(id→COMPOSITION_ROW_FIELDSの行)の各Compositionの祖先を、製品まで取得してrowsへ追加する。
+# 祖先のidは経路(path)より分かるので、まとめて1回(件数が多い場合は QUERY_CHUNK_SIZE 件毎)で取得します。
+# (経路の無いCompositionは、親を階層毎に取得します)
+def load_ancestor_rows(rows):
+    frontier = get_ancestor_ids(rows.values()) - rows.keys()
+    while frontier:
+        next_frontier = []
+        for chunk in chunked(list(frontier)):
+            for row in Composition.objects.filter(id__in=chunk).values_list(*COMPOSITION_ROW_FIELDS):
+                rows[row[0]] = row
+                next_frontier.append(row)
+        frontier = get_ancestor_ids(next_frontier) - rows.keys()
+    return rows
+
+
+# COMPOSITION_ROW_FIELDSの行の祖先のid(経路が無い場合は親のid)の集合を返す。
+def get_ancestor_ids(rows):
+    ancestor_ids = set()
+    for row in rows:
+        if row[5] is not None:
+            ancestor_ids.update(get_path_ids(row[5]))
+        elif row[1] is not None:
+            ancestor_ids.add(row[1])
+    return ancestor_ids
+
+
+def get_where_used(part_ids):
     """
-    部品の循環参照をチェックするためのヘルパー関数
-    :param id: 現在調べているCompositionオブジェクトのID
-    :param part_id: 現在調べている部品のID
-    :param visited_parts: これまでに訪れた部品のIDのセット
-    :return: 循環が存在する場合はTrue、それ以外はFalse
+    指定された部品を使用している製品を、使用箇所までの経路と員数を掛け合わせた使用数と共に返す
+    部品を使用している全てのCompositionから、経路(path)の祖先をまとめて取得して製品まで遡ります。
+    共通の親は一度だけ取得、計算されます。
+    :param part_ids: 部品のIDのリスト
+    :return: 製品毎の辞書(id, code, name, usedquantity, usages)のリスト
     """
-    if part_id in visited_parts:
-        return True  # 現在の部品が以前に訪れた部品のリストに存在する場合、循環参照が存在する
-
-    visited_parts.add(part_id)
+    rows = {}
+    # 部品を使用しているComposition(製品自身は除く)
+    for chunk in chunked(part_ids):
+        for row in Composition.objects.filter(
+            part_id__in=chunk, parent_id__isnull=False
+        ).values_list(*COMPOSITION_ROW_FIELDS):
+            rows[row[0]] = row
+    used_ids = sorted(rows)
+    load_ancestor_rows(rows)
+
+    # 製品からの経路と使用数をメモリ上で求める。(既に求めた親の結果は使い回す)
+    resolved = {}
+    for used_id in used_ids:
+        chain = []
+        chain_ids = set()
+        id = used_id
+        while id is not None and id not in resolved and id in rows and id not in chain_ids:
+            chain.append(id)
+            chain_ids.add(id)
+            id = rows[id][1]
+        if id is None:
+            # 製品まで辿れた。
+            root_id = chain.pop()
+            resolved[root_id] = ((root_id,), 1)
+            parent = resolved[root_id]
+        elif id in resolved:
+            parent = resolved[id]
+        else:
+            # 親が見つからない、もしくは親子関係が循環している。
+            parent = None
+        for id in reversed(chain):
+            if parent is not None:
+                parent = (parent[0] + (id,), parent[1] * rows[id][3])
+            resolved[id] = parent
+
+    # 経路上の部品をまとめて取得する。
+    parts = {}
+    path_part_ids = list({row[2] for row in rows.values()})
+    for chunk in chunked(path_part_ids):
+        for part_id, code, name in Part.objects.filter(id__in=chunk).values_list('id', 'code', 'name'):
+            parts[part_id] = {'code': code, 'name': name}
+
+    products = {}
+    for used_id in used_ids:
+        if resolved[used_id] is None:
+            continue
+        path_ids, usedquantity = resolved[used_id]
+        root_id = path_ids[0]
+        if root_id not in products:
+            products[root_id] = {
+                'id': root_id,
+                'code': parts[rows[root_id][2]]['code'],
+                'name': parts[rows[root_id][2]]['name'],
+                'usedquantity': 0,
+                'usages': []
+            }
+        products[root_id]['usedquantity'] += usedquantity
+        products[root_id]['usages'].append({
+            'id': used_id,
+            'usedquantity': usedquantity,
+            'path': [
+                {
+                    'id': id,
+                    'code': parts[rows[id][2]]['code'],
+                    'name': parts[rows[id][2]]['name'],
+                    'quantity': rows[id][3]
+                }
+                for id in path_ids
+            ]
+        })
+    return [products[root_id] for root_id in sorted(products)]
 
-    # 現在の部品の子部品をチェック
-    compositions = Composition.objects.filter(parent_id=id).order_by('sort')
-    for composition in compositions:
-        if is_cyclic_part(composition.id, composition.part.id, visited_parts):
-            return True
 
-    visited_parts.remove(part_id)
+def is_cyclic_part(id, part_id, children_map):
+    """
+    部品の循環参照をチェックするためのヘルパー関数
+    get_children_mapで取得済みのデータをスタックを使って辿るので、クエリは発行しません。
+    :param id: 調べ始めるCompositionオブジェクトのID
+    :param part_id: 調べ始める部品のID
+    :param children_map: get_children_mapで取得した親id毎の子のリスト
+    :return: 循環が存在する場合はTrue、それ以外はFalse
+    """
+    visited_parts = {part_id}   # 現在辿っている経路上の部品のIDのセット
+    stack = [(iter(children_map.get(id, [])), part_id)]
+    while stack:
+        children, current_part_id = stack[-1]
+        child = next(children, None)
+        if child is None:
+            # 子を全て調べ終えたら経路から外す
+            stack.pop()
+            visited_parts.discard(current_part_id)
+            continue
+        if child.part_id in visited_parts:
+            return True  # 子の部品が経路上の部品に存在する場合、循環参照が存在する
+        visited_parts.add(child.part_id)
+        stack.append((iter(children_map.get(child.id, [])), child.part_id))
     return False
 
 
 def check_for_cyclic_parts(product_id):
     """
-    指定された製品IDについて部品の循環参照をチェックする
+    指定された製品IDについて製品全体の部品の循環参照をチェックする
     :param product_id: 製品ID
     :return: 循環が存在する場合はTrue、それ以外はFalse
     """
     composition = Composition.objects.get(pk=product_id)
-    return is_cyclic_part(composition.id, composition.part.id, set())
+    return is_cyclic_part(composition.id, composition.part_id, get_children_map(composition.id))
+
+
+def get_ancestors(id):
+    """
+    指定されたCompositionから製品まで遡った経路上のCompositionのIDと部品のIDを返す
+    移動によりidの親子関係が循環してしまった場合でも、一巡した所で遡るのを止めます。
+    :param id: 遡り始めるCompositionオブジェクトのID(自身を含む)
+    :return: (CompositionのID, 部品のID)のリスト
+    """
+    ancestors = []
+    path = Composition.objects.filter(pk=id).values_list('path', flat=True).first() if id is not None else None
+    if path is not None:
+        # 経路のidより祖先をまとめて取得する。
+        part_ids = dict(Composition.objects.filter(id__in=get_path_ids(path)).values_list('id', 'part_id'))
+        return [(id, part_ids[id]) for id in reversed(get_path_ids(path)) if id in part_ids]
+    visited_ids = set()
+    while id is not None and id not in visited_ids:
+        visited_ids.add(id)
+        parent_id, part_id = Composition.objects.values_list('parent_id', 'part_id').get(pk=id)
+        ancestors.append((id, part_id))
+        id = parent_id
+    return ancestors
+
+
+def check_for_cyclic_composition(composition):
+    """
+    追加、移動したCompositionについてのみ部品の循環参照をチェックする
+    追加、移動する前の製品には循環参照が無い為、compositionとその配下の部品が、
+    親から製品まで遡った経路上の部品に含まれていなければ循環参照は発生しません。
+    そのため、製品全体の大きさに関わらず、経路の深さとcompositionの配下の件数分の処理で済みます。
+    :param composition: 追加、移動したCompositionオブジェクト
+    :return: 循環が存在する場合はTrue、それ以外はFalse
+    """
+    return check_for_cyclic_compositions([composition])
+
+
+def check_for_cyclic_compositions(compositions):
+    """
+    同じ親へまとめて追加、移動、複写したCompositionについて部品の循環参照をチェックする
+    親から製品までの経路は共通なので1回だけ取得し、各compositionとその配下の部品を調べます。
+    部品の隣接関係(PartAdjacency)は全製品の構成を部品単位にまとめたもので、配下の部品を全て含む為、
+    隣接関係を辿って経路上の部品に辿り着かない場合は、配下のCompositionを読まずに済ませます。
+    :param compositions: 同じ親へ追加、移動、複写したCompositionオブジェクトのリスト
+    :return: 循環が存在する場合はTrue、それ以外はFalse
+    """
+    ancestors = get_ancestors(compositions[0].parent_id)
+    ancestor_ids = {id for id, part_id in ancestors}
+    ancestor_part_ids = {part_id for id, part_id in ancestors}
+    for composition in compositions:
+        # 自身の配下へ移動した場合も自身の部品が経路上に現れるので循環参照となる。
+        if composition.id in ancestor_ids or composition.part_id in ancestor_part_ids:
+            return True
+    contained_part_ids = get_contained_part_ids({composition.part_id for composition in compositions},
+                                                ancestor_part_ids)
+    if contained_part_ids.isdisjoint(ancestor_part_ids):
+        return False
+    return any(descendant.part_id in ancestor_part_ids
+               for composition in compositions for descendant in get_descendants(composition.id))
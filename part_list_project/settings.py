@@ -85,6 +85,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# 構成変更画面の構成ツリーをキャッシュします。(複数プロセスで動かす場合は共有のバックエンドに変更して下さい)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'part_list',
+        'TIMEOUT': 60 * 60,
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -130,3 +143,14 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
+
+# 構成変更画面で最初に読み込む階層の深さ(None の場合は全階層)
+# 既定は全階層です。大きな製品を扱う場合は 3 などを指定すると、これより深い階層は
+# 折りたたまれた要素を展開した時に読み込みます。(?depth= で画面毎にも指定出来ます)
+PART_LIST_INITIAL_DEPTH = None
+
+# 製品毎に「元に戻す」が出来る構成変更セットの件数(None の場合は無制限)
+# これより古い構成変更セットは compact_history コマンドで削除します。
+PART_LIST_HISTORY_RETENTION = 100
+# True の場合は、構成を変更する度に確定後に構成履歴を圧縮します。
+PART_LIST_COMPACT_HISTORY_ON_COMMIT = False